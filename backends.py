@@ -0,0 +1,379 @@
+import os
+import re
+import sys
+import json
+import time
+import socket
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from myriad_core import (
+    DEFAULT_MEM, SHARD_MAGIC, compile_template, render_parameters, task_ranges, count_lines, format_task_ids,
+    shard_file_name, frame_record, append_record, index_shards,
+)
+
+# Every backend takes a single job dict with the keys below and returns a short status string:
+#   srp_trr_classic_path, param_dir, spacecraft_model_file, output_dir  - locations
+#   metrics_dir     - where each task writes its metrics record (see write_metrics_record)
+#   n_points, points_per_task, shared_params                            - task layout
+#   task_ids        - task IDs to run, or None for all of them
+#   tasks_per_shard - tasks appending their outputs to each output shard, or None to write one
+#                     output file per task (sharded tasks must use shared_params)
+#   h_rt, mem       - wall time (H:MM:SS) and memory (e.g. 512M) per task
+#   job_script_filename, task_index_file                                - SGE job script files
+#   concurrency, timeout                                                - local runs only
+
+def param_file_lines(absolute_param_files_dir, shared_params=False):
+    """
+    Returns the job script lines that set $param_file for the current $task_id.
+    """
+    if not shared_params:
+        return [f"param_file={absolute_param_files_dir}/params$(printf '%05d' $task_id).txt\n"]
+    return [
+        f"read k_start k_finish < <(sed -n \"${{task_id}}p\" {absolute_param_files_dir}/params_ranges.txt)\n",
+        "param_file=${TMPDIR:-/tmp}/params$(printf '%05d' $task_id).txt\n",
+        f"sed -e \"s/^k_start .*/k_start      = $k_start/\" -e \"s/^k_finish .*/k_finish     = $k_finish/\" {absolute_param_files_dir}/params_base.txt > $param_file\n",
+    ]
+
+def metrics_record_path(metrics_dir, task_id, tasks_per_shard=None):
+    if tasks_per_shard:
+        return os.path.join(metrics_dir, f"metrics{str((task_id - 1) // tasks_per_shard + 1).zfill(3)}.jsonl")
+    return os.path.join(metrics_dir, f"metrics{str(task_id).zfill(5)}.json")
+
+def write_metrics_record(metrics_dir, record, tasks_per_shard=None):
+    """
+    Writes a task's metrics record: a one-line JSON object with task_id, host, start and end
+    (Unix time), exit_code, max_rss_kb (null if unknown) and, for local runs, status. Sharded
+    tasks append the line to their metrics shard instead of writing a file each.
+    """
+    record_path = metrics_record_path(metrics_dir, record["task_id"], tasks_per_shard)
+    if tasks_per_shard:
+        append_record(record_path, (json.dumps(record) + "\n").encode())
+        return
+    with open(record_path + ".partial", "w") as file:
+        file.write(json.dumps(record) + "\n")
+    os.replace(record_path + ".partial", record_path)
+
+def shard_lines(absolute_output_files_dir, tasks_per_shard):
+    """
+    Returns the job script lines that append $output_file to the task's output shard as a single
+    framed record (see myriad_core.frame_record), holding an exclusive flock on the shard.
+    """
+    return [
+        f"shard_file={absolute_output_files_dir}/shard$(printf '%03d' $(( (task_id - 1) / {tasks_per_shard} + 1 ))).srp\n",
+        "if [ -f $output_file ]; then\n",
+        "    record_file=$output_file.record\n",
+        f"    printf '{SHARD_MAGIC.decode()}%d %d %s\\n' $task_id $(wc -c < $output_file) $(md5sum < $output_file | cut -d ' ' -f 1) > $record_file\n",
+        "    cat $output_file >> $record_file\n",
+        "    { flock 9 2>/dev/null; cat $record_file >&9; } 9>>$shard_file\n",
+        "    rm -f $output_file $record_file\n",
+        "fi\n",
+    ]
+
+def metrics_lines(absolute_metrics_dir, command, finish_lines=(), tasks_per_shard=None):
+    """
+    Returns the job script lines that run a command under GNU time and write its metrics record.
+
+    :param finish_lines: Lines run after the command, before the record is written.
+    :param tasks_per_shard: Append the record to the task's metrics shard instead.
+    """
+    record_line = ("printf '{\"task_id\": %d, \"host\": \"%s\", \"start\": %s, \"end\": %s, \"exit_code\": %d, \"max_rss_kb\": %s}\\n' "
+                   "$task_id \"$(hostname)\" $start $end $exit_code $max_rss_kb")
+    if tasks_per_shard:
+        metrics_file = f"{absolute_metrics_dir}/metrics$(printf '%03d' $(( (task_id - 1) / {tasks_per_shard} + 1 ))).jsonl"
+        write_lines = [f"{{ flock 9 2>/dev/null; {record_line} >&9; }} 9>>$metrics_file\n"]
+    else:
+        metrics_file = f"{absolute_metrics_dir}/metrics$(printf '%05d' $task_id).json"
+        write_lines = [f"{record_line} > $metrics_file.partial\n", "mv $metrics_file.partial $metrics_file\n"]
+    return [
+        f"metrics_file={metrics_file}\n",
+        "rss_file=${TMPDIR:-/tmp}/rss$(printf '%05d' $task_id).txt\n",
+        "start=$(date +%s.%N)\n",
+        "if [ -x /usr/bin/time ]; then\n",
+        f"    /usr/bin/time -f %M -o $rss_file {command}\n",
+        "    exit_code=$?\n",
+        "    max_rss_kb=$(tail -n 1 $rss_file 2>/dev/null)\n",
+        "else\n",
+        f"    {command}\n",
+        "    exit_code=$?\n",
+        "fi\n",
+        *finish_lines,
+        "end=$(date +%s.%N)\n",
+        "case $max_rss_kb in ''|*[!0-9]*) max_rss_kb=null;; esac\n",
+        *write_lines,
+        "exit $exit_code\n",
+    ]
+
+def write_job_script(job):
+    """
+    Writes the SGE job array script for a job.
+
+    Each array task runs srp_trr_classic once on its own parameter file, which may cover
+    several spiral points (k_start..k_finish) and so produce a multi-row output file. A
+    contiguous subset of task IDs is submitted as an SGE task range; otherwise the IDs are
+    written to job["task_index_file"], one per line, and array task i runs the task ID on line i.
+    Each task records its run time, node, exit code and peak memory in job["metrics_dir"].
+    With job["tasks_per_shard"], tasks append their output and metrics record to shared shard
+    files instead of writing one file each.
+
+    :param job: Job dict (see the top of this module).
+    :return: Path of the job script.
+    """
+    # Ensure absolute paths are used for directories and files
+    absolute_output_files_dir = os.path.abspath(job["output_dir"])
+    absolute_param_files_dir = os.path.abspath(job["param_dir"])
+    absolute_spacecraft_model_file = os.path.abspath(job["spacecraft_model_file"])
+    absolute_metrics_dir = os.path.abspath(job["metrics_dir"])
+    os.makedirs(absolute_metrics_dir, exist_ok=True)
+
+    task_id_line = "task_id=$SGE_TASK_ID\n"
+    task_range = f"1-{len(task_ranges(job['n_points'], job['points_per_task']))}"
+    task_ids = job.get("task_ids")
+    if task_ids:
+        task_ids = sorted(task_ids)
+        if task_ids[-1] - task_ids[0] + 1 == len(task_ids):
+            task_range = f"{task_ids[0]}-{task_ids[-1]}"
+        else:
+            absolute_task_index_file = os.path.abspath(job["task_index_file"])
+            with open(absolute_task_index_file, "w") as index_file:
+                index_file.writelines(f"{task_id}\n" for task_id in task_ids)
+            task_range = f"1-{len(task_ids)}"
+            task_id_line = f"task_id=$(sed -n \"${{SGE_TASK_ID}}p\" {absolute_task_index_file})\n"
+
+    # Sharded tasks write their output on the node and append it to their shard when done
+    tasks_per_shard = job.get("tasks_per_shard")
+    output_dir, finish_lines = absolute_output_files_dir, ()
+    if tasks_per_shard:
+        output_dir, finish_lines = "${TMPDIR:-/tmp}", shard_lines(absolute_output_files_dir, tasks_per_shard)
+
+    job_script_filename = job.get("job_script_filename", "job_array_script.sh")
+    with open(job_script_filename, "w") as file:
+        file.writelines([
+            "#!/bin/bash -l\n",
+            "#$ -S /bin/bash\n",
+            f"#$ -l h_rt={job['h_rt']}\n",
+            f"#$ -l mem={job.get('mem', DEFAULT_MEM)}\n",
+            f"#$ -t {task_range}\n",
+            "#$ -N srp_trr_job_array\n",
+            f"#$ -wd {absolute_output_files_dir}\n\n",
+            "module unload mkl/10.2.5/035\n",
+            "module unload mpi/qlogic/1.2.7/intel\n",
+            "module unload compilers/intel/11.1/072\n",
+            "module load compilers/gnu/4.1.2\n",
+            "module load mpi/qlogic/1.2.7/gnu\n\n",
+            task_id_line,
+            *param_file_lines(absolute_param_files_dir, job["shared_params"]),
+            f"output_file={output_dir}/output$(printf '%05d' $task_id).txt\n\n",
+            *metrics_lines(absolute_metrics_dir, f"{job['srp_trr_classic_path']} $param_file {absolute_spacecraft_model_file} $output_file",
+                           finish_lines, tasks_per_shard),
+        ])
+    return job_script_filename
+
+def sge_array(job):
+    """
+    Submits the job as an SGE job array with qsub.
+
+    :return: The qsub output (normally the job ID message).
+    """
+    job_script_filename = write_job_script(job)
+    result = subprocess.run(["qsub", job_script_filename], capture_output=True, text=True)
+    print(result.stdout + result.stderr, end="")
+    return result.stdout.strip()
+
+def sge_job_id(qsub_output):
+    """
+    Extracts the job ID from qsub's "Your job-array 12345.1-100:1 (...) has been submitted" message.
+    """
+    match = re.search(r"Your job(?:-array)? (\d+)", qsub_output or "")
+    return match.group(1) if match else None
+
+def _parse_memory_mb(value):
+    """
+    Converts a qacct memory figure such as 1.234G or 512.000M into megabytes.
+    """
+    units = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 ** 2}
+    value = value.strip()
+    if value and value[-1].upper() in units:
+        return float(value[:-1]) * units[value[-1].upper()]
+    return float(value) / 1024 ** 2
+
+def sge_accounting(job_id):
+    """
+    Reads the accounting records of a finished SGE job with qacct.
+
+    :return: List of dicts with task_id, hostname, exit_status, failed, wallclock (s) and
+        maxvmem_mb, one per array task; empty if qacct is unavailable or knows no such job.
+    """
+    try:
+        result = subprocess.run(["qacct", "-j", str(job_id)], capture_output=True, text=True)
+    except OSError:
+        return []
+    records = []
+    for block in re.split(r"^=+\s*$", result.stdout, flags=re.M):
+        fields = dict(line.split(None, 1) for line in block.strip().splitlines() if len(line.split(None, 1)) == 2)
+        if "taskid" not in fields or not fields["taskid"].strip().isdigit():
+            continue
+        records.append({
+            "task_id": int(fields["taskid"]),
+            "hostname": fields.get("hostname", "").strip(),
+            "exit_status": int(fields.get("exit_status", "0").split()[0]),
+            "failed": int(fields.get("failed", "0").split()[0]),
+            "wallclock": float(fields.get("ru_wallclock", "0").strip().rstrip("s")),
+            "maxvmem_mb": _parse_memory_mb(fields.get("maxvmem", "0")),
+        })
+    return records
+
+def dry_run(job):
+    """
+    Writes the SGE job script but does not submit it.
+    """
+    job_script_filename = write_job_script(job)
+    message = f"Dry run: wrote {job_script_filename}; submit it with 'qsub {job_script_filename}'."
+    print(message)
+    return message
+
+def _local_param_file(job, task_id, k_start, k_finish, tmp_dir, compiled_template):
+    """
+    Returns the parameter file for a task, materialising it from the shared base if needed.
+    """
+    if not job["shared_params"]:
+        return os.path.join(job["param_dir"], f"params{str(task_id).zfill(5)}.txt")
+    param_file = os.path.join(tmp_dir, f"params{str(task_id).zfill(5)}.txt")
+    with open(param_file, "w") as file:
+        file.write(render_parameters(compiled_template, {"k_start": k_start, "k_finish": k_finish}))
+    return param_file
+
+def _run_with_rusage(args, timeout, stderr_file):
+    """
+    Runs a command and reaps it with os.wait4, which (unlike subprocess.run) reports the peak
+    memory of that child alone.
+
+    :return: Tuple of (exit code, peak RSS in kB).
+    :raises subprocess.TimeoutExpired: If the command ran for longer than timeout seconds.
+    """
+    process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=stderr_file)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        pid, wait_status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            process.kill()
+            os.wait4(process.pid, 0)
+            process.returncode = -9
+            raise subprocess.TimeoutExpired(args, timeout)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    max_rss_kb = rusage.ru_maxrss // 1024 if sys.platform == "darwin" else rusage.ru_maxrss
+    return process.returncode, max_rss_kb
+
+def _run_local_task(job, task_id, k_start, k_finish, tmp_dir, compiled_template):
+    """
+    Runs one task in a subprocess, writing to a .partial file that is renamed into place only
+    when srp_trr_classic exits cleanly with a complete output, and writes its metrics record.
+    Sharded tasks write the .partial file in tmp_dir and append a complete output to their shard.
+
+    :return: Tuple of (task_id, status, elapsed seconds); status is "ok" on success.
+    """
+    tasks_per_shard = job.get("tasks_per_shard")
+    output_file = os.path.join(job["output_dir"], f"output{str(task_id).zfill(5)}.txt")
+    partial_file = output_file + ".partial"
+    if tasks_per_shard:
+        partial_file = os.path.join(tmp_dir, os.path.basename(partial_file))
+    record = {"task_id": task_id, "host": socket.gethostname(), "start": time.time(), "exit_code": None, "max_rss_kb": None}
+    start = time.monotonic()
+    try:
+        param_file = _local_param_file(job, task_id, k_start, k_finish, tmp_dir, compiled_template)
+        with tempfile.TemporaryFile(mode="w+", dir=tmp_dir) as stderr_file:
+            record["exit_code"], record["max_rss_kb"] = _run_with_rusage(
+                [job["srp_trr_classic_path"], param_file, job["spacecraft_model_file"], partial_file], job.get("timeout"), stderr_file)
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+        if record["exit_code"] != 0:
+            status = f"exit code {record['exit_code']}" + (f": {stderr.strip()[-200:]}" if stderr.strip() else "")
+        elif not os.path.exists(partial_file) or count_lines(partial_file) != 1 + k_finish - k_start + 1:
+            status = "incomplete output"
+        else:
+            status = "ok"
+    except subprocess.TimeoutExpired:
+        status = f"timed out after {job.get('timeout')}s"
+    except OSError as error:
+        status = str(error)
+
+    if status == "ok" and tasks_per_shard:
+        with open(partial_file, "rb") as file:
+            append_record(os.path.join(job["output_dir"], shard_file_name(task_id, tasks_per_shard)), frame_record(task_id, file.read()))
+        os.remove(partial_file)
+    elif status == "ok":
+        os.replace(partial_file, output_file)
+    elif os.path.exists(partial_file):
+        os.remove(partial_file)
+    elapsed = time.monotonic() - start
+    record.update({"end": record["start"] + elapsed, "status": status})
+    write_metrics_record(job["metrics_dir"], record, tasks_per_shard)
+    return task_id, status, elapsed
+
+def local_processes(job):
+    """
+    Runs the tasks on this machine, driving one srp_trr_classic subprocess per task from a pool of
+    job["concurrency"] threads (default: one per CPU).
+
+    Tasks whose output already exists with the expected number of lines are skipped. Each task is
+    killed after job["timeout"] seconds if set, outputs only appear once complete, and progress and
+    throughput are printed as tasks finish.
+    """
+    os.makedirs(job["metrics_dir"], exist_ok=True)
+    ranges = task_ranges(job["n_points"], job["points_per_task"])
+    task_ids = job.get("task_ids") or range(1, len(ranges) + 1)
+
+    shard_outputs = index_shards(job["output_dir"], ranges)[0] if job.get("tasks_per_shard") else None
+    pending = []
+    for task_id in task_ids:
+        k_start, k_finish = ranges[task_id - 1]
+        if shard_outputs is not None:
+            if task_id in shard_outputs and shard_outputs[task_id][3] == 1 + k_finish - k_start + 1:
+                continue
+        else:
+            output_file = os.path.join(job["output_dir"], f"output{str(task_id).zfill(5)}.txt")
+            if os.path.exists(output_file) and count_lines(output_file) == 1 + k_finish - k_start + 1:
+                continue
+        pending.append((task_id, k_start, k_finish))
+    skipped = len(task_ids) - len(pending)
+    if skipped:
+        print(f"Skipping {skipped} tasks whose output is already complete.")
+
+    failed = []
+    points_done = 0
+    start = time.monotonic()
+    compiled_template = None
+    if job["shared_params"]:
+        compiled_template = compile_template(os.path.join(job["param_dir"], "params_base.txt"))
+
+    with tempfile.TemporaryDirectory() as tmp_dir, ThreadPoolExecutor(max_workers=job.get("concurrency") or os.cpu_count()) as executor:
+        futures = {executor.submit(_run_local_task, job, task_id, k_start, k_finish, tmp_dir, compiled_template): k_finish - k_start + 1
+                   for task_id, k_start, k_finish in pending}
+        for done, future in enumerate(as_completed(futures), start=1):
+            task_id, status, elapsed = future.result()
+            if status == "ok":
+                points_done += futures[future]
+            else:
+                failed.append(task_id)
+            wall = time.monotonic() - start
+            print(f"[{done}/{len(pending)}] task {task_id}: {status} in {elapsed:.1f}s "
+                  f"({done / wall:.2f} tasks/s, {points_done / wall:.2f} points/s)")
+
+    message = f"Ran {len(pending)} tasks locally: {len(pending) - len(failed)} succeeded, {len(failed)} failed, {skipped} skipped."
+    if failed:
+        message += f" Failed task IDs: {format_task_ids(failed)}"
+    print(message)
+    return message
+
+BACKENDS = {
+    "sge": sge_array,
+    "local": local_processes,
+    "dry-run": dry_run,
+}
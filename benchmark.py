@@ -0,0 +1,307 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import traceback
+import multiprocessing
+from collections import Counter
+
+from backends import BACKENDS
+from myriad_core import (
+    RES_DIR, generate_parameter_files, read_parameter_file, task_ranges, legion_check, legion_combine,
+    incremental_combine, shard_file_name, frame_record, append_record, CHECK_CACHE_FILE, COMBINE_MANIFEST_FILE,
+    COMBINE_RUN_ROWS, TASKS_PER_SHARD,
+)
+
+# Times the submit/check/combine/interpolate stages as the number of spiral points grows, with a
+# stand-in for srp_trr_classic (this script, run with --stub) and a mocked qsub, so it runs on
+# any machine. Every stage runs in a forked child process so its peak memory and file
+# operations are its own.
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_RESULTS_FILE = "benchmark_results.json"
+# Audit events (see sys.addaudithook) counted as file operations; os.stat is not audited
+FILE_EVENTS = ("open", "os.scandir", "os.listdir", "os.remove", "os.rename", "os.mkdir", "os.truncate", "shutil.rmtree", "subprocess.Popen")
+REGRESSION_THRESHOLD = 1.25
+GOLDEN_ANGLE_DEG = 180 * (3 - math.sqrt(5))
+
+def stub_output(k_start, k_finish, n_points):
+    """
+    Returns a synthetic srp_trr_classic output: a header plus one row per spiral point of
+    k_start..k_finish, on a Fibonacci spiral with a smooth acceleration field.
+    """
+    lines = ["Sun_lat,Sun_lon,acc_X,acc_Y,acc_Z,EPS_angle\n"]
+    for k in range(k_start, k_finish + 1):
+        lat = math.degrees(math.asin(-1 + (2 * k - 1) / n_points))
+        lon = (k * GOLDEN_ANGLE_DEG + 180) % 360 - 180
+        x, y, z = math.cos(math.radians(lat)) * math.cos(math.radians(lon)), math.cos(math.radians(lat)) * math.sin(math.radians(lon)), math.sin(math.radians(lat))
+        lines.append(f"{lat:.6f},{lon:.6f},{-9.1e-8 * x:.9e},{-9.1e-8 * y + 1.2e-9 * z:.9e},{-9.1e-8 * z:.9e},0.0\n")
+    return "".join(lines)
+
+def write_stub_output(param_file, output_file):
+    """
+    Writes the stub output for the k_start..k_finish of a parameter file.
+    """
+    values = read_parameter_file(param_file)
+    with open(output_file, 'w') as file:
+        file.write(stub_output(int(values["k_start"]), int(values["k_finish"]), int(values["n_points"])))
+
+def write_mock_executables(bin_dir):
+    """
+    Writes a qsub that accepts a job script without running it and answers like SGE, and an
+    srp_trr_classic stand-in that runs write_stub_output.
+
+    :return: Path of the srp_trr_classic stand-in.
+    """
+    qsub_path = os.path.join(bin_dir, "qsub")
+    with open(qsub_path, 'w') as file:
+        file.write("#!/bin/sh\necho 'Your job-array 1.1-1:1 (\"srp_trr_job_array\") has been submitted'\n")
+    stub_path = os.path.join(bin_dir, "srp_trr_classic")
+    with open(stub_path, 'w') as file:
+        file.write(f"#!/bin/sh\nexec {sys.executable} {os.path.abspath(__file__)} --stub \"$@\"\n")
+    for path in (qsub_path, stub_path):
+        os.chmod(path, 0o755)
+    return stub_path
+
+def _proc_io():
+    # Bytes read and written through system calls (Linux only)
+    try:
+        with open("/proc/self/io", 'r') as file:
+            fields = dict(line.split(": ") for line in file.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def _max_rss_kb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss // 1024 if sys.platform == "darwin" else max_rss
+
+def _stage_child(connection, function, args):
+    counts = Counter()
+
+    def count_file_events(event, _):
+        if event in FILE_EVENTS:
+            counts[event] += 1
+
+    try:
+        read_start, write_start = _proc_io()
+        rss_start = _max_rss_kb()
+        sys.addaudithook(count_file_events)
+        start = time.perf_counter()
+        function(*args)
+        wall_seconds = time.perf_counter() - start
+        read_end, write_end = _proc_io()
+        connection.send({
+            "wall_seconds": wall_seconds,
+            "peak_rss_kb": _max_rss_kb(),
+            "rss_growth_kb": _max_rss_kb() - rss_start,
+            "file_ops": dict(counts),
+            "bytes_read": None if read_start is None else read_end - read_start,
+            "bytes_written": None if write_start is None else write_end - write_start,
+        })
+    except BaseException:
+        connection.send({"error": traceback.format_exc()})
+    finally:
+        connection.close()
+
+def run_stage(stage, n_points, function, *args):
+    """
+    Runs function(*args) in a forked child process and returns its measurements.
+
+    :return: Dict with stage, n_points, wall_seconds, peak_rss_kb, rss_growth_kb (growth of the
+        peak over the size inherited from this process), file_ops (audited events by name),
+        bytes_read and bytes_written (None where /proc/self/io is unavailable), or error.
+    """
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_stage_child, args=(sender, function, args))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": f"stage process exited with code {process.exitcode}"}
+    process.join()
+    result = {"stage": stage, "n_points": n_points, **result}
+    if "error" in result:
+        print(f"{stage:<22} N={n_points:<7} failed:\n{result['error']}")
+    else:
+        print(f"{stage:<22} N={n_points:<7} {result['wall_seconds']:9.3f}s  peak {result['peak_rss_kb'] / 1024:7.1f}MB  "
+              f"(+{result['rss_growth_kb'] / 1024:.1f}MB)  file ops {sum(result['file_ops'].values())}")
+    return result
+
+def _write_stub_outputs(param_prefix, output_dir, n_tasks):
+    for task_id in range(1, n_tasks + 1):
+        write_stub_output(f"{param_prefix}{str(task_id).zfill(5)}.txt", os.path.join(output_dir, f"output{str(task_id).zfill(5)}.txt"))
+
+def _write_stub_shards(shard_dir, n_points, points_per_task, tasks_per_shard):
+    for task_id, (k_start, k_finish) in enumerate(task_ranges(n_points, points_per_task), start=1):
+        append_record(os.path.join(shard_dir, shard_file_name(task_id, tasks_per_shard)),
+                      frame_record(task_id, stub_output(k_start, k_finish, n_points).encode()))
+
+def _run_check(output_dir, n_points, points_per_task, fresh, sharded=False):
+    if fresh and os.path.exists(os.path.join(output_dir, CHECK_CACHE_FILE)):
+        os.remove(os.path.join(output_dir, CHECK_CACHE_FILE))
+    failed = legion_check(output_dir, n_points, os.devnull, points_per_task, sharded=sharded)
+    if failed:
+        raise RuntimeError(f"legion_check reported {len(failed)} failed tasks")
+
+def _run_incremental_combine(output_dir, n_points, points_per_task, fresh, sharded=False):
+    if fresh and os.path.exists(os.path.join(output_dir, COMBINE_MANIFEST_FILE)):
+        os.remove(os.path.join(output_dir, COMBINE_MANIFEST_FILE))
+    incremental_combine(output_dir, os.path.join(output_dir, "incremental_output.npy"), n_points, points_per_task, sharded=sharded)
+
+def _run_interpolate(binary_file, resolution):
+    from interpolate_grid import read_data, interpolate_data
+    interpolate_data(read_data(binary_file), resolution=resolution)
+
+def benchmark_size(n_points, work_dir, stub_path, points_per_task=1, local_max_points=0, resolution=1.0, template_file=None, tasks_per_shard=TASKS_PER_SHARD):
+    """
+    Runs every stage for one number of spiral points in a fresh directory under work_dir.
+
+    qsub must be the mock from write_mock_executables; stub_path is its srp_trr_classic stand-in.
+
+    :param local_max_points: Also time the local backend running the stub as a subprocess per
+        task, for campaigns up to this many points (process start-up dominates beyond that).
+    :param tasks_per_shard: Tasks per output shard in the sharded stages.
+    :return: List of stage results (see run_stage).
+    """
+    template_file = template_file or os.path.join(RES_DIR, "parameters_template.txt")
+    run_dir = tempfile.mkdtemp(prefix=f"bench_{n_points}_", dir=work_dir)
+    output_dir = os.path.join(run_dir, "outputFiles")
+    param_dir = os.path.join(run_dir, "paramFiles")
+    metrics_dir = os.path.join(run_dir, "metrics")
+    shard_dir = os.path.join(run_dir, "shardedOutputFiles")
+    for directory in (output_dir, param_dir, shard_dir, os.path.join(run_dir, "shared")):
+        os.makedirs(directory)
+    param_prefix = os.path.join(param_dir, "params")
+    n_tasks = len(task_ranges(n_points, points_per_task))
+    settings = ("0", "1", "0.01", "N", "0.0")
+    job = {
+        "srp_trr_classic_path": stub_path,
+        "param_dir": param_dir,
+        "spacecraft_model_file": os.devnull,
+        "output_dir": output_dir,
+        "metrics_dir": metrics_dir,
+        "n_points": n_points,
+        "points_per_task": points_per_task,
+        "shared_params": False,
+        "task_ids": None,
+        "h_rt": "1:00:00",
+        "job_script_filename": os.path.join(run_dir, "job_array_script.sh"),
+    }
+
+    results = []
+    try:
+        results.append(run_stage("generate_params", n_points, generate_parameter_files, template_file, param_prefix, n_points, *settings, points_per_task))
+        results.append(run_stage("generate_params_again", n_points, generate_parameter_files, template_file, param_prefix, n_points, *settings, points_per_task))
+        results.append(run_stage("generate_params_shared", n_points, generate_parameter_files, template_file,
+                                 os.path.join(run_dir, "shared", "params"), n_points, *settings, points_per_task, True))
+        results.append(run_stage("submit_sge_mock_qsub", n_points, BACKENDS["sge"], job))
+        results.append(run_stage("stub_outputs", n_points, _write_stub_outputs, param_prefix, output_dir, n_tasks))
+        results.append(run_stage("check", n_points, _run_check, output_dir, n_points, points_per_task, True))
+        results.append(run_stage("check_cached", n_points, _run_check, output_dir, n_points, points_per_task, False))
+        results.append(run_stage("combine", n_points, legion_combine, output_dir, os.path.join(output_dir, "combined_output.txt"), n_tasks,
+                                 COMBINE_RUN_ROWS, os.path.join(output_dir, "combined_output.npy")))
+        results.append(run_stage("combine_incremental", n_points, _run_incremental_combine, output_dir, n_points, points_per_task, True))
+        results.append(run_stage("combine_incremental_noop", n_points, _run_incremental_combine, output_dir, n_points, points_per_task, False))
+        results.append(run_stage("stub_outputs_sharded", n_points, _write_stub_shards, shard_dir, n_points, points_per_task, tasks_per_shard))
+        results.append(run_stage("check_sharded", n_points, _run_check, shard_dir, n_points, points_per_task, True, True))
+        results.append(run_stage("combine_sharded", n_points, legion_combine, shard_dir, os.path.join(shard_dir, "combined_output.txt"), n_tasks,
+                                 COMBINE_RUN_ROWS, os.path.join(shard_dir, "combined_output.npy"), None, task_ranges(n_points, points_per_task)))
+        results.append(run_stage("combine_incremental_sharded", n_points, _run_incremental_combine, shard_dir, n_points, points_per_task, True, True))
+        try:
+            import interpolate_grid  # noqa: F401 (needs NumPy, SciPy and pandas)
+            results.append(run_stage("interpolate", n_points, _run_interpolate, os.path.join(output_dir, "combined_output.npy"), resolution))
+        except ImportError as error:
+            print(f"Skipping interpolate: {error}")
+        if n_points <= local_max_points:
+            # A separate output directory, so the stub really runs every task
+            local_job = dict(job, output_dir=os.path.join(run_dir, "localOutputFiles"), concurrency=os.cpu_count())
+            os.makedirs(local_job["output_dir"])
+            results.append(run_stage("local_backend_stub", n_points, BACKENDS["local"], local_job))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return results
+
+def compare_results(results, baseline_file, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares wall times with an earlier results file.
+
+    :return: List of (stage, n_points, baseline seconds, seconds) slower than threshold times the baseline.
+    """
+    with open(baseline_file, 'r') as file:
+        baseline = {(result["stage"], result["n_points"]): result for result in json.load(file)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["stage"], result["n_points"]))
+        if previous and "wall_seconds" in previous and "wall_seconds" in result:
+            if result["wall_seconds"] > threshold * previous["wall_seconds"]:
+                regressions.append((result["stage"], result["n_points"], previous["wall_seconds"], result["wall_seconds"]))
+    return regressions
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the submit/check/combine/interpolate pipeline with a stub srp_trr_classic and a mocked qsub.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="numbers of spiral points to run")
+    parser.add_argument("--points-per-task", type=int, default=1)
+    parser.add_argument("--tasks-per-shard", type=int, default=TASKS_PER_SHARD, help="tasks per output shard in the sharded stages")
+    parser.add_argument("--work-dir", default=None, help="directory for the synthetic campaigns, e.g. on Scratch (default: system temp)")
+    parser.add_argument("--res-dir", default="res", help="directory holding parameters_template.txt")
+    parser.add_argument("--resolution", type=float, default=1.0, help="grid spacing of the interpolate stage (degrees)")
+    parser.add_argument("--local-max-points", type=int, default=1000, help="also time the local backend up to this many points")
+    parser.add_argument("-o", "--output", default=DEFAULT_RESULTS_FILE, help="JSON results file")
+    parser.add_argument("--compare", metavar="BASELINE", help="earlier results file; exit with status 1 if a stage got slower")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="slowdown factor counted as a regression")
+    parser.add_argument("--stub", nargs=3, metavar=("PARAM_FILE", "MODEL_FILE", "OUTPUT_FILE"), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.stub:
+        write_stub_output(args.stub[0], args.stub[2])
+        return 0
+
+    bin_dir = tempfile.mkdtemp(prefix="bench_bin_")
+    stub_path = write_mock_executables(bin_dir)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    results = []
+    try:
+        for n_points in args.sizes:
+            results += benchmark_size(n_points, args.work_dir, stub_path, args.points_per_task, args.local_max_points, args.resolution,
+                                      os.path.join(args.res_dir, "parameters_template.txt"), args.tasks_per_shard)
+    finally:
+        shutil.rmtree(bin_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as file:
+        json.dump({"environment": environment(), "points_per_task": args.points_per_task, "results": results}, file, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        regressions = compare_results(results, args.compare, args.threshold)
+        for stage, n_points, before, after in regressions:
+            print(f"Regression: {stage} at N={n_points} took {after:.3f}s, was {before:.3f}s")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import os
+import json
+import math
+import hashlib
+import numpy as np
+
+from spacecraft_model import load_model, panel_geometry
+from myriad_core import parse_walltime, format_walltime
+
+# srp_trr_classic traces one ray per pixel of an array that must cover the spacecraft from every
+# direction, testing each ray against every panel, so the work per spiral point scales with
+# (pixels in the array) x (panels), and roughly doubles when secondary reflections are traced.
+# The defaults below are rough guesses; calibrate() replaces them with timings of completed runs.
+DEFAULT_SECONDS_PER_UNIT = 1e-6
+DEFAULT_OVERHEAD_SECONDS = 5.0
+SECONDARY_REFLECTION_FACTOR = 2.0
+DEFAULT_MEM_MB = 512
+MIN_MEM_MB = 256
+MEM_STEP_MB = 64
+MEM_SAFETY = 1.3
+RUNTIME_SAFETY = 1.5
+STARTUP_MARGIN_SECONDS = 600
+DEFAULT_TARGET_WALLTIME = "4:00:00"
+MAX_H_RT = "48:00:00"
+CALIBRATION_FILE = os.path.join(os.path.expanduser("~"), ".cache", "myriad_utils_py", "cost_calibration.json")
+
+def cost_features(model_file, spacing, sr_option):
+    """
+    Summarises the parts of a run that drive its cost.
+
+    The pixel array is taken to be a square as wide as the model's bounding box diagonal, the
+    smallest array that covers the model from any direction. The model is identified by the
+    SHA-256 of its file, so calibration samples can be matched to it.
+
+    :param model_file: Path to the spacecraft model file.
+    :param spacing: Pixel spacing of the array (m).
+    :param sr_option: Whether secondary reflections are traced (Y or N).
+    :return: Dict with model (SHA-256), panels, array_area (m^2), pixels, secondary_reflections
+        and work units.
+    """
+    with open(model_file, 'rb') as file:
+        digest = hashlib.sha256(file.read()).hexdigest()
+    model = load_model(model_file)
+    _, boxes, _ = panel_geometry(model)
+    diagonal = float(np.linalg.norm(np.nanmax(boxes[:, 1], axis=0) - np.nanmin(boxes[:, 0], axis=0)))
+    pixels = (diagonal / float(spacing)) ** 2
+    secondary_reflections = str(sr_option).strip().upper() == "Y"
+    work = pixels * len(model["kinds"]) * (SECONDARY_REFLECTION_FACTOR if secondary_reflections else 1.0)
+    return {
+        "model": digest,
+        "panels": int(len(model["kinds"])),
+        "array_area": diagonal ** 2,
+        "pixels": pixels,
+        "secondary_reflections": secondary_reflections,
+        "work": work,
+    }
+
+def read_calibration(calibration_file=CALIBRATION_FILE):
+    """
+    Returns the calibration samples recorded by calibrate(), oldest first.
+    """
+    if not os.path.exists(calibration_file):
+        return []
+    with open(calibration_file, 'r') as file:
+        return json.load(file)
+
+def calibrate(features, timings, source, calibration_file=CALIBRATION_FILE):
+    """
+    Records the measured cost of a completed run as a calibration sample.
+
+    :param features: cost_features() of the run.
+    :param timings: List of (points in the task, wall seconds, peak memory in MB or None) for
+        each successful task.
+    :param source: Identifies the run (e.g. mission and job ID); a later sample from the same
+        source replaces the earlier one.
+    :return: The recorded sample, or None if there were no timings.
+    """
+    if not timings:
+        return None
+    points = np.array([timing[0] for timing in timings], dtype=float)
+    seconds = np.array([timing[1] for timing in timings], dtype=float)
+    peaks = [timing[2] for timing in timings if timing[2]]
+    sample = dict(features)
+    sample.update({
+        "source": source,
+        "tasks": len(timings),
+        "seconds_per_point": float(np.median(seconds / points)),
+        "peak_mem_mb": float(max(peaks)) if peaks else None,
+    })
+
+    samples = [existing for existing in read_calibration(calibration_file) if existing["source"] != source]
+    samples.append(sample)
+    os.makedirs(os.path.dirname(calibration_file) or ".", exist_ok=True)
+    tmp_path = f"{calibration_file}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(samples, file, indent=2)
+    os.replace(tmp_path, calibration_file)
+    return sample
+
+def fit_cost(samples):
+    """
+    Fits seconds_per_point = overhead + rate * work to the calibration samples.
+
+    With a single sample (or samples of equal work, or a fit with a negative term) only the rate
+    is rescaled and the overhead keeps its default. Runs faster than the default overhead
+    instead scale the whole default estimate down to the measurements.
+
+    :return: Tuple of (overhead seconds, seconds per work unit).
+    """
+    if not samples:
+        return DEFAULT_OVERHEAD_SECONDS, DEFAULT_SECONDS_PER_UNIT
+    work = np.array([sample["work"] for sample in samples], dtype=float)
+    seconds = np.array([sample["seconds_per_point"] for sample in samples], dtype=float)
+    if len(samples) >= 2 and np.ptp(work) > 0:
+        rate, overhead = np.polyfit(work, seconds, 1)
+        if rate > 0 and overhead >= 0:
+            return float(overhead), float(rate)
+    rate = np.median(np.maximum(seconds - DEFAULT_OVERHEAD_SECONDS, 0) / work)
+    if rate > 0:
+        return DEFAULT_OVERHEAD_SECONDS, float(rate)
+    scale = float(np.median(seconds / (DEFAULT_OVERHEAD_SECONDS + DEFAULT_SECONDS_PER_UNIT * work)))
+    return DEFAULT_OVERHEAD_SECONDS * scale, DEFAULT_SECONDS_PER_UNIT * scale
+
+def _same_model(sample, features):
+    return sample.get("model") is not None and sample.get("model") == features.get("model")
+
+def is_calibrated(features, calibration_file=CALIBRATION_FILE):
+    """
+    Returns whether a calibrated run of the same model has been recorded.
+    """
+    return any(_same_model(sample, features) for sample in read_calibration(calibration_file))
+
+def estimate_mem_mb(features, samples):
+    """
+    Estimates the memory to request per task from the largest peak seen in calibrated runs of the
+    same model, or DEFAULT_MEM_MB if it has none; peaks of other models say little about it.
+    """
+    peaks = [sample["peak_mem_mb"] for sample in samples if sample.get("peak_mem_mb") and _same_model(sample, features)]
+    if not peaks:
+        return DEFAULT_MEM_MB
+    mem_mb = max(peaks) * MEM_SAFETY
+    return max(MIN_MEM_MB, int(math.ceil(mem_mb / MEM_STEP_MB)) * MEM_STEP_MB)
+
+def estimate_seconds_per_point(features, calibration_file=CALIBRATION_FILE):
+    """
+    Estimates the run time of one spiral point from the calibrated cost fit.
+    """
+    overhead, rate = fit_cost(read_calibration(calibration_file))
+    return overhead + rate * features["work"]
+
+def walltime_for_points(points_per_task, seconds_per_point):
+    """
+    Returns the h_rt (H:MM:SS) for a task of points_per_task points: the estimate with a safety
+    factor plus the startup margin, rounded up to whole 5 minutes and capped at MAX_H_RT.
+    """
+    h_rt_seconds = points_per_task * seconds_per_point * RUNTIME_SAFETY + STARTUP_MARGIN_SECONDS
+    return format_walltime(min(math.ceil(h_rt_seconds / 300) * 300, parse_walltime(MAX_H_RT)))
+
+def plan_resources(features, n_points, target_walltime=None, seconds_per_point=None, calibration_file=CALIBRATION_FILE):
+    """
+    Picks the points per task, wall time and memory for a run.
+
+    Tasks are packed with as many spiral points as fit in the target wall time after a safety
+    factor, and h_rt is then set from the estimate for that many points rather than the target,
+    so short runs do not ask for more time than they need.
+
+    :param features: cost_features() of the run.
+    :param n_points: Total number of spiral points.
+    :param target_walltime: Longest wall time wanted per task (H:MM:SS).
+    :param seconds_per_point: Use this run time per point instead of the fitted estimate.
+    :return: Dict with points_per_task, h_rt, mem and seconds_per_point.
+    """
+    samples = read_calibration(calibration_file)
+    if seconds_per_point is None:
+        seconds_per_point = estimate_seconds_per_point(features, calibration_file)
+    target_seconds = min(parse_walltime(target_walltime or DEFAULT_TARGET_WALLTIME), parse_walltime(MAX_H_RT))
+
+    budget = max(target_seconds - STARTUP_MARGIN_SECONDS, 0)
+    points_per_task = max(1, min(int(n_points), int(budget // (seconds_per_point * RUNTIME_SAFETY))))
+    return {
+        "points_per_task": points_per_task,
+        "h_rt": walltime_for_points(points_per_task, seconds_per_point),
+        "mem": f"{estimate_mem_mb(features, samples)}M",
+        "seconds_per_point": float(seconds_per_point),
+    }
@@ -1,50 +1,315 @@
+import os
+import gzip
+import argparse
+import hashlib
+import tempfile
+import zipfile
 import numpy as np
 import pandas as pd
-from scipy.interpolate import Rbf
+import scipy
+from scipy.interpolate import RBFInterpolator
+
+# Up to this many points the exact global RBF system is solved; beyond it each
+# evaluation uses only its nearest neighbours (found with a KD-tree)
+GLOBAL_FIT_MAX_POINTS = 2000
+DEFAULT_NEIGHBORS = 64
+EVAL_BATCH_SIZE = 100000
+
+# Fitted interpolators by (input file, file size, mtime, settings), so one process fits each input once
+_FITTED_INTERPOLATORS = {}
+
+# Interpolated values persisted across runs, keyed on a hash of the input contents, the fit
+# settings and the query directions. Evaluation, not the fit, dominates for neighbour-limited
+# interpolators, so the values are cached rather than the fit. The least recently used entries
+# are evicted beyond these limits.
+INTERPOLATION_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'myriad_utils_py', 'interpolations')
+INTERPOLATION_CACHE_MAX_ENTRIES = 16
+INTERPOLATION_CACHE_MAX_BYTES = 2 * 1024 ** 3
 
 def read_data(file_path):
+    # combined_output.npy is memory-mapped rather than parsed; columns are accessed by name either way
+    if file_path.endswith('.npy'):
+        return np.load(file_path, mmap_mode='r')
     data = pd.read_csv(file_path)
     return data
 
-def interpolate_data(data):
-    latitudes = np.linspace(-90, 90, 181)
-    longitudes = np.linspace(-180, 180, 361)
-    
-    # Original data points
-    sun_lat = data['Sun_lat'].values
-    sun_lon = data['Sun_lon'].values
-    acc_X = data['acc_X'].values
-    acc_Y = data['acc_Y'].values
-    acc_Z = data['acc_Z'].values
-    
-    # Create RBF interpolators
-    rbf_X = Rbf(sun_lat, sun_lon, acc_X, function='thin_plate')
-    rbf_Y = Rbf(sun_lat, sun_lon, acc_Y, function='thin_plate')
-    rbf_Z = Rbf(sun_lat, sun_lon, acc_Z, function='thin_plate')
-    
+def to_unit_vectors(lat, lon):
+    # Working on the unit sphere avoids the pole singularity and the +/-180 deg seam of raw lat/lon
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+def fit_interpolator(data, neighbors=None, kernel='thin_plate_spline', smoothing=0.0):
+    """
+    Fits one vector-valued RBF interpolator for (acc_X, acc_Y, acc_Z) over the Sun directions.
+
+    neighbors=None picks the exact global solve for small inputs and DEFAULT_NEIGHBORS otherwise.
+    """
+    points = to_unit_vectors(data['Sun_lat'], data['Sun_lon'])
+    values = np.column_stack((np.asarray(data['acc_X']), np.asarray(data['acc_Y']), np.asarray(data['acc_Z'])))
+
+    # Repeated directions would make the RBF system singular
+    points, unique_index = np.unique(points, axis=0, return_index=True)
+    values = values[unique_index]
+
+    if neighbors is None and len(points) > GLOBAL_FIT_MAX_POINTS:
+        neighbors = DEFAULT_NEIGHBORS
+    if neighbors is not None:
+        neighbors = min(int(neighbors), len(points))
+    return RBFInterpolator(points, values, neighbors=neighbors, kernel=kernel, smoothing=smoothing)
+
+def evaluate_interpolator(interpolator, lat, lon, batch_size=EVAL_BATCH_SIZE):
+    # Returns acc_X, acc_Y, acc_Z with the shape of lat/lon, evaluated in bounded-memory batches
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    flat_lat = lat.ravel()
+    flat_lon = lon.ravel()
+    result = np.empty((flat_lat.size, 3))
+    for start in range(0, flat_lat.size, batch_size):
+        stop = start + batch_size
+        result[start:stop] = interpolator(to_unit_vectors(flat_lat[start:stop], flat_lon[start:stop]))
+    return tuple(result[:, i].reshape(lat.shape) for i in range(3))
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def interpolation_cache_key(input_file, lat, lon, neighbors=None, kernel='thin_plate_spline', smoothing=0.0):
+    # The scipy version is part of the key in case RBFInterpolator's results change between releases
+    settings = f"{neighbors}|{kernel}|{smoothing}|{GLOBAL_FIT_MAX_POINTS}|{DEFAULT_NEIGHBORS}|scipy {scipy.__version__}"
+    digest = hashlib.sha256(f"{file_digest(input_file)}|{settings}|{np.shape(lat)}".encode())
+    digest.update(np.ascontiguousarray(lat, dtype=float).tobytes())
+    digest.update(np.ascontiguousarray(lon, dtype=float).tobytes())
+    return digest.hexdigest()
+
+def evict_interpolation_cache(cache_dir, max_entries=INTERPOLATION_CACHE_MAX_ENTRIES, max_bytes=INTERPOLATION_CACHE_MAX_BYTES):
+    # Least recently used first out; a cache hit refreshes the entry's mtime
+    entries = []
+    with os.scandir(cache_dir) as listing:
+        for entry in listing:
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort(reverse=True)
+    kept_bytes = 0
+    for count, (_, size, path) in enumerate(entries, start=1):
+        kept_bytes += size
+        if count > max_entries or (count > 1 and kept_bytes > max_bytes):
+            os.remove(path)
+
+def load_interpolator(input_file, neighbors=None, kernel='thin_plate_spline', smoothing=0.0):
+    """
+    Reads and fits input_file, reusing the fit in memory while the file is unchanged.
+    """
+    stat = os.stat(input_file)
+    key = (os.path.abspath(input_file), stat.st_size, stat.st_mtime_ns, neighbors, kernel, smoothing)
+    if key not in _FITTED_INTERPOLATORS:
+        _FITTED_INTERPOLATORS[key] = fit_interpolator(read_data(input_file), neighbors=neighbors, kernel=kernel, smoothing=smoothing)
+    return _FITTED_INTERPOLATORS[key]
+
+def interpolate_file(input_file, lat, lon, neighbors=None, kernel='thin_plate_spline', smoothing=0.0, cache_dir=INTERPOLATION_CACHE_DIR):
+    """
+    Interpolates input_file at the given Sun directions, reusing earlier results where possible.
+
+    Unless cache_dir is None, the values are saved to cache_dir under a hash of the input contents,
+    the fit settings and lat/lon, so a later run for the same grid or query skips both the fit and
+    the evaluation.
+
+    :return: acc_X, acc_Y, acc_Z with the shape of lat/lon.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    cache_path = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, interpolation_cache_key(input_file, lat, lon, neighbors, kernel, smoothing) + '.npy')
+        try:
+            values = np.load(cache_path, mmap_mode='r')
+            if values.shape == (lat.size, 3):
+                os.utime(cache_path)
+                return tuple(values[:, i].reshape(lat.shape) for i in range(3))
+        except (OSError, ValueError):
+            pass
+
+    interpolator = load_interpolator(input_file, neighbors=neighbors, kernel=kernel, smoothing=smoothing)
+    acc = evaluate_interpolator(interpolator, lat, lon)
+    if cache_path is not None:
+        # Write then rename so a concurrent run never reads a partial entry
+        with tempfile.NamedTemporaryFile('wb', dir=cache_dir, suffix='.tmp', delete=False) as f:
+            np.save(f, np.column_stack([component.ravel() for component in acc]))
+        os.replace(f.name, cache_path)
+        evict_interpolation_cache(cache_dir)
+    return acc
+
+def evaluate_directions(interpolator, directions, batch_size=EVAL_BATCH_SIZE):
+    # Evaluates at arbitrary (n, 3) direction vectors, which need not be normalised
+    directions = np.asarray(directions, dtype=float)
+    directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    result = np.empty((len(directions), 3))
+    for start in range(0, len(directions), batch_size):
+        result[start:start + batch_size] = interpolator(directions[start:start + batch_size])
+    return result[:, 0], result[:, 1], result[:, 2]
+
+def make_grid(resolution=1.0, lat_bounds=(-90.0, 90.0), lon_bounds=(-180.0, 180.0)):
+    # Regular lat/lon axes in degrees, including both bounds
+    lat_count = int(round((lat_bounds[1] - lat_bounds[0]) / resolution)) + 1
+    lon_count = int(round((lon_bounds[1] - lon_bounds[0]) / resolution)) + 1
+    return np.linspace(lat_bounds[0], lat_bounds[1], lat_count), np.linspace(lon_bounds[0], lon_bounds[1], lon_count)
+
+def read_query_directions(file_path):
+    """
+    Reads query directions as (Sun_lat, Sun_lon) in degrees.
+
+    The file (CSV or .npy) holds either Sun_lat/Sun_lon columns or x/y/z direction components,
+    e.g. Sun directions in the body frame along an orbit ephemeris.
+    """
+    data = read_data(file_path)
+    names = data.dtype.names if isinstance(data, np.ndarray) else tuple(data.columns)
+    if 'Sun_lat' in names and 'Sun_lon' in names:
+        return np.asarray(data['Sun_lat'], dtype=float), np.asarray(data['Sun_lon'], dtype=float)
+    directions = np.column_stack([np.asarray(data[axis], dtype=float) for axis in ('x', 'y', 'z')])
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    lat = np.degrees(np.arcsin(np.clip(directions[:, 2], -1.0, 1.0)))
+    lon = np.degrees(np.arctan2(directions[:, 1], directions[:, 0]))
+    return lat, lon
+
+def interpolate_data(data, neighbors=None, resolution=1.0, lat_bounds=(-90.0, 90.0), lon_bounds=(-180.0, 180.0), interpolator=None):
+    latitudes, longitudes = make_grid(resolution, lat_bounds, lon_bounds)
+
+    if interpolator is None:
+        interpolator = fit_interpolator(data, neighbors=neighbors)
+
     lat_grid, lon_grid = np.meshgrid(latitudes, longitudes, indexing='ij')
-    
+
     # Interpolate the data
-    acc_X_interp = rbf_X(lat_grid, lon_grid)
-    acc_Y_interp = rbf_Y(lat_grid, lon_grid)
-    acc_Z_interp = rbf_Z(lat_grid, lon_grid)
-    
+    acc_X_interp, acc_Y_interp, acc_Z_interp = evaluate_interpolator(interpolator, lat_grid, lon_grid)
+
     return latitudes, longitudes, acc_X_interp, acc_Y_interp, acc_Z_interp
 
-def save_interpolated_data(output_path, latitudes, longitudes, acc_X_interp, acc_Y_interp, acc_Z_interp):
-    with open(output_path, 'w') as f:
-        f.write('Sun_lat,Sun_lon,acc_X,acc_Y,acc_Z\n')
-        for i, lat in enumerate(latitudes):
-            for j, lon in enumerate(longitudes):
-                f.write(f"{lat},{lon},{acc_X_interp[i, j]},{acc_Y_interp[i, j]},{acc_Z_interp[i, j]}\n")
+OUTPUT_COLUMNS = ('Sun_lat', 'Sun_lon', 'acc_X', 'acc_Y', 'acc_Z')
+WRITE_CHUNK_ROWS = 500000
+
+def _grid_chunks(latitudes, longitudes, acc_X_interp, acc_Y_interp, acc_Z_interp, chunk_rows=WRITE_CHUNK_ROWS):
+    # Yields (rows, 5) blocks of whole latitude rows, in the same lat-major order as the grid
+    latitudes = np.asarray(latitudes)
+    longitudes = np.asarray(longitudes)
+    lats_per_chunk = max(1, chunk_rows // len(longitudes))
+    for start in range(0, len(latitudes), lats_per_chunk):
+        stop = min(start + lats_per_chunk, len(latitudes))
+        block = np.empty((stop - start, len(longitudes), 5))
+        block[:, :, 0] = latitudes[start:stop, None]
+        block[:, :, 1] = longitudes[None, :]
+        block[:, :, 2] = acc_X_interp[start:stop]
+        block[:, :, 3] = acc_Y_interp[start:stop]
+        block[:, :, 4] = acc_Z_interp[start:stop]
+        yield block.reshape(-1, 5)
+
+def _write_csv_chunks(f, chunks):
+    f.write(','.join(OUTPUT_COLUMNS) + '\n')
+    row_format = ','.join(['%r'] * len(OUTPUT_COLUMNS)) + '\n'
+    for chunk in chunks:
+        # One formatting call per chunk instead of one f-string per cell
+        f.write((row_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+def _point_chunks(lat, lon, acc_X, acc_Y, acc_Z, chunk_rows=WRITE_CHUNK_ROWS):
+    # Yields (rows, 5) blocks of scattered query points, in input order
+    columns = [np.asarray(column, dtype=float).ravel() for column in (lat, lon, acc_X, acc_Y, acc_Z)]
+    for start in range(0, len(columns[0]), chunk_rows):
+        yield np.column_stack([column[start:start + chunk_rows] for column in columns])
 
-def main():
+def save_interpolated_data(output_path, latitudes, longitudes, acc_X_interp, acc_Y_interp, acc_Z_interp, output_format=None):
+    """
+    Writes the interpolated grid in chunks of whole latitude rows.
+
+    output_format is one of 'csv', 'csv.gz' (gzip-compressed CSV), 'npy' (structured array with one
+    float64 field per column) or 'npz' (compressed structured array); by default it follows the
+    extension of output_path, falling back to CSV.
+    """
+    chunks = _grid_chunks(latitudes, longitudes, acc_X_interp, acc_Y_interp, acc_Z_interp)
+    _save_table(output_path, chunks, len(latitudes) * len(longitudes), output_format)
+
+def save_point_data(output_path, lat, lon, acc_X, acc_Y, acc_Z, output_format=None):
+    # Same formats as save_interpolated_data, for values at arbitrary query directions
+    _save_table(output_path, _point_chunks(lat, lon, acc_X, acc_Y, acc_Z), np.size(lat), output_format)
+
+def _save_table(output_path, chunks, n_rows, output_format=None):
+    if output_format is None:
+        output_format = 'csv'
+        for extension in ('csv.gz', 'txt.gz', 'npy', 'npz'):
+            if output_path.endswith('.' + extension):
+                output_format = 'csv.gz' if extension.endswith('.gz') else extension
+
+    if output_format == 'csv':
+        with open(output_path, 'w') as f:
+            _write_csv_chunks(f, chunks)
+    elif output_format == 'csv.gz':
+        with gzip.open(output_path, 'wt', compresslevel=6) as f:
+            _write_csv_chunks(f, chunks)
+    elif output_format == 'npy':
+        dtype = np.dtype([(name, '<f8') for name in OUTPUT_COLUMNS])
+        table = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=(n_rows,))
+        start = 0
+        for chunk in chunks:
+            table.view('<f8').reshape(n_rows, 5)[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        table.flush()
+    elif output_format == 'npz':
+        # The same layout np.savez_compressed writes (one deflated grid.npy member), streamed chunk
+        # by chunk; the rows of a (rows, 5) float64 chunk are exactly the structured records
+        dtype = np.dtype([(name, '<f8') for name in OUTPUT_COLUMNS])
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (n_rows,)}
+        with zipfile.ZipFile(output_path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            with archive.open('grid.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_1_0(f, header)
+                for chunk in chunks:
+                    f.write(np.ascontiguousarray(chunk, dtype='<f8').tobytes())
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+def default_input_file():
     input_file = 'Scratch/AntTest/spiralPoints/outputFiles/combined_output.txt'
-    output_file = 'combined_output_interp.txt'
-    
-    data = read_data(input_file)
-    latitudes, longitudes, acc_X_interp, acc_Y_interp, acc_Z_interp = interpolate_data(data)
-    save_interpolated_data(output_file, latitudes, longitudes, acc_X_interp, acc_Y_interp, acc_Z_interp)
+    binary_input_file = input_file[:-len('.txt')] + '.npy'
+    if os.path.exists(binary_input_file):
+        input_file = binary_input_file
+    return input_file
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Interpolate combined SRP/TRR output onto a lat/lon grid or onto arbitrary Sun directions.")
+    parser.add_argument('input_file', nargs='?', default=None, help="combined_output .txt or .npy (default: the AntTest combined output)")
+    parser.add_argument('-o', '--output', default='combined_output_interp.txt', help="grid output file; the extension selects the format (.txt/.csv, .csv.gz, .npy, .npz)")
+    parser.add_argument('--resolution', type=float, default=1.0, help="grid spacing in degrees")
+    parser.add_argument('--lat-min', type=float, default=-90.0)
+    parser.add_argument('--lat-max', type=float, default=90.0)
+    parser.add_argument('--lon-min', type=float, default=-180.0)
+    parser.add_argument('--lon-max', type=float, default=180.0)
+    parser.add_argument('--query', action='append', default=[], metavar='FILE',
+                        help="file of query directions (Sun_lat/Sun_lon or x/y/z columns); results go to FILE's name with an _interp suffix. May be repeated")
+    parser.add_argument('--no-grid', action='store_true', help="only evaluate the --query files")
+    parser.add_argument('--neighbors', type=int, default=None, help="nearest points used per evaluation (default: global fit for small inputs)")
+    parser.add_argument('--cache-dir', default=INTERPOLATION_CACHE_DIR, help="directory of cached interpolated values")
+    parser.add_argument('--no-cache', action='store_true', help="neither read nor write the on-disk cache of interpolated values")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    input_file = args.input_file or default_input_file()
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    if not args.no_grid:
+        latitudes, longitudes = make_grid(args.resolution, (args.lat_min, args.lat_max), (args.lon_min, args.lon_max))
+        lat_grid, lon_grid = np.meshgrid(latitudes, longitudes, indexing='ij')
+        acc_X_interp, acc_Y_interp, acc_Z_interp = interpolate_file(input_file, lat_grid, lon_grid, neighbors=args.neighbors, cache_dir=cache_dir)
+        save_interpolated_data(args.output, latitudes, longitudes, acc_X_interp, acc_Y_interp, acc_Z_interp)
+
+    for query_file in args.query:
+        lat, lon = read_query_directions(query_file)
+        acc_X, acc_Y, acc_Z = interpolate_file(input_file, lat, lon, neighbors=args.neighbors, cache_dir=cache_dir)
+        stem, extension = os.path.splitext(query_file)
+        save_point_data(f"{stem}_interp{extension or '.txt'}", lat, lon, acc_X, acc_Y, acc_Z)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
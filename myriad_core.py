@@ -0,0 +1,1132 @@
+import os
+import shutil
+import json
+import math
+import heapq
+import tempfile
+import struct
+import fcntl
+import hashlib
+import statistics
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+HOME_DIR = os.path.expanduser("~")
+SCRATCH_DIR = os.path.join(HOME_DIR, "Scratch")
+SRP_TRR_CLASSIC_PATH = os.path.join(HOME_DIR, "srp_trr_classic/bin/srp_trr_classic")
+RES_DIR = os.path.join(HOME_DIR, "res")
+CAMPAIGN_FILE = "campaign.json"
+DEFAULT_H_RT = "5:00:0"
+DEFAULT_MEM = "512M"
+PARAM_WRITE_WORKERS = 16
+PARAM_WRITE_BATCH = 256
+COMBINED_HEADER = "Sun_lat,Sun_lon,acc_X,acc_Y,acc_Z,EPS_angle\n"
+COMBINE_RUN_ROWS = 200000
+COMBINE_MERGE_FAN_IN = 64
+NPY_FIELDS = COMBINED_HEADER.strip().split(",")
+NPY_ROW = struct.Struct("<" + "d" * len(NPY_FIELDS))
+NPY_FLUSH_ROWS = 4096
+CHECK_CACHE_FILE = ".legion_check_cache.json"
+COMBINE_MANIFEST_FILE = ".combine_manifest.json"
+CHECK_WORKERS = 16
+STRAGGLER_FACTOR = 2.0
+SLOW_NODE_FACTOR = 1.5
+COUNT_CHUNK_BYTES = 1 << 20
+TASKS_PER_SHARD = 1000
+SHARD_MAGIC = b"@@srp "
+
+def generate_directory_structure(base_dir, mission):
+    """
+    Generates the directory structure for the given mission.
+    """
+    output_dir = os.path.join(base_dir, mission, "spiralPoints", "outputFiles")
+    param_dir = os.path.join(base_dir, mission, "spiralPoints", "paramFiles")
+
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(param_dir, exist_ok=True)
+
+    return output_dir, param_dir
+
+def mission_paths(mission_id, home_dir=HOME_DIR, scratch_dir=SCRATCH_DIR, refinement_pass=None):
+    """
+    Returns the standard file locations for a mission.
+
+    :param mission_id: Name of the mission.
+    :param home_dir: Directory holding the {mission_id}/{mission_id}.txt spacecraft model.
+    :param scratch_dir: Directory under which the job inputs and outputs are written.
+    :param refinement_pass: Number of an adaptive refinement pass; its files live in
+        spiralPoints/refineNN rather than spiralPoints.
+    :return: Dict with campaign_dir, output_dir, param_dir, metrics_dir, spacecraft_model_file,
+        check_log_file and report_file.
+    """
+    campaign_dir = os.path.join(scratch_dir, mission_id, "spiralPoints")
+    suffix = ""
+    if refinement_pass:
+        campaign_dir = os.path.join(campaign_dir, f"refine{str(refinement_pass).zfill(2)}")
+        suffix = f"_refine{str(refinement_pass).zfill(2)}"
+    return {
+        "campaign_dir": campaign_dir,
+        "output_dir": os.path.join(campaign_dir, "outputFiles"),
+        "param_dir": os.path.join(campaign_dir, "paramFiles"),
+        "metrics_dir": os.path.join(campaign_dir, "metrics"),
+        "spacecraft_model_file": os.path.join(home_dir, mission_id, f"{mission_id}.txt"),
+        "check_log_file": os.path.join(home_dir, mission_id, f"legion_check_log{suffix}.txt"),
+        "report_file": os.path.join(home_dir, mission_id, f"campaign_report{suffix}.txt"),
+    }
+
+def task_ranges(n_points, points_per_task=1):
+    """
+    Splits the spiral point indices 1..n_points into contiguous ranges, one per array task.
+
+    :param n_points: Total number of spiral points.
+    :param points_per_task: Number of spiral points computed by each array task.
+    :return: List of (k_start, k_finish) tuples; task i (1-based) covers entry i - 1.
+    """
+    points_per_task = max(1, int(points_per_task))
+    return [(k, min(k + points_per_task - 1, n_points)) for k in range(1, n_points + 1, points_per_task)]
+
+def parse_walltime(walltime):
+    """
+    Converts an SGE style wall time (H:MM:SS) into seconds.
+    """
+    seconds = 0
+    for field in str(walltime).split(":"):
+        seconds = seconds * 60 + float(field)
+    return seconds
+
+def format_walltime(seconds):
+    """
+    Converts a number of seconds into an SGE style wall time (H:MM:SS).
+    """
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}"
+
+def points_per_task_for_walltime(target_walltime, seconds_per_point):
+    """
+    Sizes the array task chunks so that each task fits inside a target wall time.
+
+    :param target_walltime: Target wall time per task, in seconds or as H:MM:SS.
+    :param seconds_per_point: Estimated srp_trr_classic run time for a single spiral point (s).
+    :return: Number of spiral points per array task (at least 1).
+    """
+    return max(1, int(parse_walltime(target_walltime) // float(seconds_per_point)))
+
+def write_campaign_state(campaign_dir, n_points, points_per_task, shared_params=False, h_rt=DEFAULT_H_RT, backend="sge", mem=DEFAULT_MEM, cost=None, task_ids=None, tasks_per_shard=None):
+    """
+    Records the task layout of a submission so check/combine know what each output file covers.
+
+    :param campaign_dir: The mission's spiralPoints directory.
+    :param n_points: Total number of spiral points.
+    :param points_per_task: Number of spiral points computed by each array task.
+    :param shared_params: Whether the tasks read a shared base parameter file plus a range index.
+    :param h_rt: Wall time requested for each array task.
+    :param backend: Name of the execution backend the tasks were run with.
+    :param mem: Memory requested for each array task.
+    :param cost: Cost model features of the run (see cost_model.cost_features), if known.
+    :param task_ids: The task IDs submitted, if only some of the layout's tasks were.
+    :param tasks_per_shard: Tasks appending to each output shard, or None if every task writes
+        its own output file.
+    """
+    state = {
+        "n_points": int(n_points),
+        "points_per_task": int(points_per_task),
+        "shared_params": bool(shared_params),
+        "h_rt": h_rt,
+        "mem": mem,
+        "backend": backend,
+        "cost": cost,
+        "task_ids": format_task_ids(task_ids) if task_ids else None,
+        "tasks_per_shard": int(tasks_per_shard) if tasks_per_shard else None,
+        "resubmissions": [],
+    }
+    with open(os.path.join(campaign_dir, CAMPAIGN_FILE), 'w') as file:
+        json.dump(state, file, indent=2)
+
+def update_campaign_state(campaign_dir, updates):
+    """
+    Sets top-level fields of the campaign state file.
+    """
+    state = read_campaign_state(campaign_dir)
+    state.update(updates)
+    with open(os.path.join(campaign_dir, CAMPAIGN_FILE), 'w') as file:
+        json.dump(state, file, indent=2)
+
+def record_resubmission(campaign_dir, record):
+    """
+    Appends a resubmission attempt to the campaign state file.
+
+    :param campaign_dir: The mission's spiralPoints directory.
+    :param record: Dict describing the attempt (task IDs, job script, qsub output, ...).
+    """
+    state = read_campaign_state(campaign_dir)
+    state.setdefault("resubmissions", []).append(record)
+    with open(os.path.join(campaign_dir, CAMPAIGN_FILE), 'w') as file:
+        json.dump(state, file, indent=2)
+
+def read_campaign_state(campaign_dir):
+    """
+    Reads the task layout written by write_campaign_state, or None for older submissions.
+    """
+    state_path = os.path.join(campaign_dir, CAMPAIGN_FILE)
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, 'r') as file:
+        return json.load(file)
+
+def compile_template(template_filename):
+    """
+    Parses a parameter template once so that many parameter files can be rendered from it.
+
+    :param template_filename: Path to the template file.
+    :return: Tuple of (template lines, dict mapping each parameter name to its line index).
+    """
+    with open(template_filename, 'r') as template_file:
+        lines = template_file.readlines()
+
+    key_index = {}
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped and not stripped.startswith("//") and "=" in stripped:
+            key_index[stripped.split("=", 1)[0].strip()] = i
+    return lines, key_index
+
+def render_parameters(compiled_template, values):
+    """
+    Renders a compiled template with the given parameter values substituted.
+
+    :param compiled_template: Result of compile_template.
+    :param values: Dict of parameter name to value; names missing from the template are ignored.
+    :return: The full parameter file contents as a single string.
+    """
+    lines, key_index = compiled_template
+    lines = list(lines)
+    for key, value in values.items():
+        if key in key_index:
+            lines[key_index[key]] = f"{key:<13}= {value}\n"
+    return "".join(lines)
+
+def write_if_changed(path, content):
+    """
+    Writes content to path in a single call, skipping the write if the file already holds it.
+
+    :return: True if the file was written, False if it was unchanged.
+    """
+    try:
+        if os.path.getsize(path) == len(content.encode()):
+            with open(path, 'r') as file:
+                if file.read() == content:
+                    return False
+    except OSError:
+        pass
+    with open(path, 'w') as file:
+        file.write(content)
+    return True
+
+def _write_batch(batch):
+    return sum(write_if_changed(path, content) for path, content in batch)
+
+def generate_parameter_files(template_filename, output_prefix, n_points, model_type, scheme, spacing, sr_option, emissivity, points_per_task=1, shared_params=False, task_ids=None):
+    """
+    Generates parameter files based on a template with user-defined settings.
+
+    The template is parsed once and each file is rendered in memory and written with a single
+    call. Writes are batched across a thread pool and files that already hold the right
+    contents are left untouched, so re-submitting only rewrites what changed.
+
+    :param template_filename: Path to the template file.
+    :param output_prefix: Prefix for the output files.
+    :param n_points: Total number of spiral points.
+    :param model_type: Type of modeling required (0 for SRP, 1 for SRP+TRR, 2 for TRR).
+    :param scheme: Pixel array orientation scheme (0 for EPS angles, 1 for spiral points).
+    :param spacing: Pixel spacing of the array.
+    :param sr_option: Option to include secondary reflections (Y or N).
+    :param emissivity: MLI emissivity for TRR models.
+    :param points_per_task: Number of spiral points packed into each parameter file (one file per array task).
+    :param shared_params: Write a single {output_prefix}_base.txt plus a {output_prefix}_ranges.txt index
+        holding "k_start k_finish" for each task, instead of one parameter file per task.
+    :param task_ids: Only write the parameter files of these tasks (the range index always covers all).
+    :return: Number of array tasks the parameters cover.
+    """
+    compiled_template = compile_template(template_filename)
+    ranges = task_ranges(n_points, points_per_task)
+    values = {
+        "model_type": model_type,
+        "scheme": scheme,
+        "spacing": spacing,
+        "sr_option": sr_option,
+        "emissivity": emissivity,
+        "k_start": 1,
+        "k_finish": n_points,
+        "n_points": n_points,
+    }
+
+    if shared_params:
+        write_if_changed(f"{output_prefix}_base.txt", render_parameters(compiled_template, values))
+        write_if_changed(f"{output_prefix}_ranges.txt", "".join(f"{k_start} {k_finish}\n" for k_start, k_finish in ranges))
+        return len(ranges)
+
+    files = []
+    for file_index in task_ids or range(1, len(ranges) + 1):
+        k_start, k_finish = ranges[file_index - 1]
+        values["k_start"] = k_start
+        values["k_finish"] = k_finish
+        files.append((f"{output_prefix}{str(file_index).zfill(5)}.txt", render_parameters(compiled_template, values)))
+
+    batches = [files[i:i + PARAM_WRITE_BATCH] for i in range(0, len(files), PARAM_WRITE_BATCH)]
+    with ThreadPoolExecutor(max_workers=PARAM_WRITE_WORKERS) as executor:
+        written = sum(executor.map(_write_batch, batches))
+    if written < len(files):
+        print(f"{len(files) - written} of {len(files)} parameter files were already up to date.")
+
+    return len(ranges)
+
+def read_parameter_file(file_path):
+    """
+    Reads the "key = value" settings of a parameter file written by generate_parameter_files.
+    """
+    values = {}
+    with open(file_path, 'r') as file:
+        for line in file:
+            key, separator, value = line.partition("=")
+            if separator and not line.startswith("//"):
+                values[key.strip()] = value.strip()
+    return values
+
+def setup_environment(mission, mass, res_dir, home_dir):
+    """
+    Sets up the environment for UCL SRP force model computation.
+
+    :param mission: Name of the mission.
+    :param mass: Mass of the spacecraft.
+    :param res_dir: Directory where resources are located.
+    :param home_dir: Home directory path.
+    """
+    # Create necessary directories
+    mission_dirs = [
+        # [Previous directory setup code remains unchanged]
+    ]
+    for dir_path in mission_dirs:
+        os.makedirs(dir_path, exist_ok=True)
+
+    # Copy parameter file and update spacecraft mass
+    shutil.copy(f"{res_dir}/parameters_template.txt", f"{home_dir}/{mission}/parameters.txt")
+    with open(f"{home_dir}/{mission}/parameters.txt", 'r') as file:
+        lines = file.readlines()
+
+    updated_lines = []
+    mass_line_found = False
+    for line in lines:
+        if "// mass of spacecraft (kg)" in line and not mass_line_found:
+            updated_lines.append(line)  # Keep the comment line
+            mass_line_found = True  # Flag to indicate the mass line is next
+        elif mass_line_found:
+            updated_lines.append(f"mass         = {mass}\n")  # Update the mass value
+            mass_line_found = False  # Reset the flag
+        else:
+            updated_lines.append(line)  # Keep all other lines as they are
+
+    with open(f"{home_dir}/{mission}/parameters.txt", 'w') as file:
+        file.writelines(updated_lines)
+
+def convert_line_endings_to_local(filename, output_prefix="local"):
+    """
+    Converts line endings in the file to Unix-style (LF) and writes to a new file.
+
+    :param filename: The name of the file to be converted.
+    :param output_prefix: The prefix for the output file.
+    """
+    with open(filename, 'r', newline=None) as f:
+        content = f.read()
+    
+    new_content = content.replace('\r\n', '\n').replace('\r', '\n')
+    with open(output_prefix + filename, 'w', newline='\n') as w:
+        w.write(new_content)
+
+def format_task_ids(task_ids):
+    """
+    Formats task IDs as compact SGE style ranges, e.g. [1, 2, 3, 7] -> "1-3,7".
+    """
+    parts = []
+    task_ids = sorted(task_ids)
+    start = 0
+    for i in range(1, len(task_ids) + 1):
+        if i == len(task_ids) or task_ids[i] != task_ids[i - 1] + 1:
+            first, last = task_ids[start], task_ids[i - 1]
+            parts.append(str(first) if first == last else f"{first}-{last}")
+            start = i
+    return ",".join(parts)
+
+def parse_task_ids(formatted):
+    """
+    Expands SGE style ranges written by format_task_ids, e.g. "1-3,7" -> [1, 2, 3, 7].
+    """
+    task_ids = []
+    for part in filter(None, formatted.split(",")):
+        first, _, last = part.partition("-")
+        task_ids.extend(range(int(first), int(last or first) + 1))
+    return task_ids
+
+def count_lines(file_path):
+    """
+    Counts the lines in a file using bulk byte reads; a final line without a newline still counts.
+    """
+    lines = 0
+    last_chunk = b""
+    with open(file_path, 'rb') as file:
+        while True:
+            chunk = file.read(COUNT_CHUNK_BYTES)
+            if not chunk:
+                break
+            lines += chunk.count(b"\n")
+            last_chunk = chunk
+    if last_chunk and not last_chunk.endswith(b"\n"):
+        lines += 1
+    return lines
+
+def shard_file_name(task_id, tasks_per_shard=TASKS_PER_SHARD):
+    """
+    Returns the name of the output shard a task appends to; tasks 1..tasks_per_shard share the first.
+    """
+    return f"shard{str((task_id - 1) // int(tasks_per_shard) + 1).zfill(3)}.srp"
+
+def frame_record(task_id, payload):
+    """
+    Frames a task's output (bytes) as a shard record: a "@@srp <task_id> <length> <md5>" header
+    line followed by the output itself.
+    """
+    return SHARD_MAGIC + f"{task_id} {len(payload)} {hashlib.md5(payload).hexdigest()}\n".encode() + payload
+
+def append_record(shard_path, record):
+    """
+    Appends a record to a shard in a single O_APPEND write, holding an exclusive flock so that
+    records from concurrent tasks cannot interleave. Where the filesystem does not support flock
+    the write goes ahead unlocked; the checksum still exposes a torn record.
+    """
+    fd = os.open(shard_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError:
+            pass
+        view = memoryview(record)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def read_shard_records(shard_path):
+    """
+    Streams the records of an output shard, oldest first.
+
+    A record that is cut short (e.g. its task was killed mid-write) or fails its checksum is
+    skipped by resuming at the next record header.
+
+    :return: Generator of (task_id, payload offset, payload bytes), with task_id and payload None
+        for a damaged record.
+    """
+    with open(shard_path, 'rb') as file:
+        while True:
+            offset = file.tell()
+            header = file.readline()
+            if not header:
+                return
+            fields = header[len(SHARD_MAGIC):].split() if header.startswith(SHARD_MAGIC) else []
+            if len(fields) == 3 and fields[0].isdigit() and fields[1].isdigit():
+                payload = file.read(int(fields[1]))
+                if len(payload) == int(fields[1]) and hashlib.md5(payload).hexdigest().encode() == fields[2]:
+                    yield int(fields[0]), offset + len(header), payload
+                    continue
+            yield None, offset, None
+            # Resume at the next header, which a torn record may have left mid-line
+            file.seek(offset + 1)
+            for line in file:
+                index = line.find(SHARD_MAGIC)
+                if index >= 0:
+                    file.seek(file.tell() - len(line) + index)
+                    break
+
+def _payload_lines(payload):
+    return payload.count(b"\n") + (1 if payload and not payload.endswith(b"\n") else 0)
+
+def index_shards(output_dir, ranges):
+    """
+    Reads every output shard in output_dir once and locates each task's output.
+
+    A task's output is its latest complete record (one header plus one row per spiral point),
+    or its latest record if none is complete; records from resubmissions supersede earlier ones.
+
+    :param ranges: The task layout, as returned by task_ranges.
+    :return: Tuple of (dict of task ID to (shard path, payload offset, payload length, line
+        count), number of damaged records).
+    """
+    outputs = {}
+    damaged = 0
+    with os.scandir(output_dir) as entries:
+        shard_paths = sorted(entry.path for entry in entries if entry.name.startswith("shard") and entry.name.endswith(".srp"))
+    for shard_path in shard_paths:
+        for task_id, offset, payload in read_shard_records(shard_path):
+            if task_id is None:
+                damaged += 1
+                continue
+            if not 1 <= task_id <= len(ranges):
+                continue
+            k_start, k_finish = ranges[task_id - 1]
+            line_count = _payload_lines(payload)
+            previous = outputs.get(task_id)
+            if previous is None or line_count == 1 + k_finish - k_start + 1 or previous[3] != 1 + k_finish - k_start + 1:
+                outputs[task_id] = (shard_path, offset, len(payload), line_count)
+    return outputs, damaged
+
+def _file_lines(file_path):
+    with open(file_path, 'r') as file:
+        yield from file
+
+def _shard_output_lines(outputs, task_ids):
+    """
+    Yields (output name, lines) for the given tasks' outputs located by index_shards. Each shard
+    is opened once and only the located records are read, at their offsets and in file order;
+    index_shards has already verified their checksums.
+    """
+    wanted = defaultdict(list)
+    for task_id in task_ids:
+        shard_path, offset, length = outputs[task_id][:3]
+        wanted[shard_path].append((offset, length, task_id))
+    for shard_path in sorted(wanted):
+        with open(shard_path, 'rb') as file:
+            for offset, length, task_id in sorted(wanted[shard_path]):
+                file.seek(offset)
+                yield f"output{str(task_id).zfill(5)}.txt", file.read(length).decode().splitlines(keepends=True)
+
+def _check_output_files(output_dir, ranges, task_ids, workers):
+    """
+    Finds the missing and malformed per-task output files for legion_check.
+    """
+    missing_files = []
+    line_count_issues = []
+    failed_task_ids = []
+
+    with os.scandir(output_dir) as entries:
+        listing = {entry.name: entry for entry in entries if entry.name.startswith("output")}
+
+    cache_path = os.path.join(output_dir, CHECK_CACHE_FILE)
+    try:
+        with open(cache_path, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        cache = {}
+    validated = {}
+
+    # Check for missing files, and find those that changed since the last check
+    to_count = []
+    for task_id in task_ids or range(1, len(ranges) + 1):
+        k_start, k_finish = ranges[task_id - 1]
+        file_name = f"output{str(task_id).zfill(5)}.txt"
+        entry = listing.get(file_name)
+        if entry is None:
+            missing_files.append(file_name)
+            failed_task_ids.append(task_id)
+            continue
+        # One header plus one row per spiral point
+        expected_lines = 1 + k_finish - k_start + 1
+        stat = entry.stat()
+        signature = [stat.st_size, stat.st_mtime_ns, expected_lines]
+        if cache.get(file_name) == signature:
+            validated[file_name] = signature
+        else:
+            to_count.append((task_id, file_name, entry.path, signature))
+
+    # Check line counts
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        line_counts = executor.map(count_lines, [path for _, _, path, _ in to_count])
+        for (task_id, file_name, _, signature), line_count in zip(to_count, line_counts):
+            if line_count == signature[2]:
+                validated[file_name] = signature
+            else:
+                line_count_issues.append((file_name, line_count))
+                failed_task_ids.append(task_id)
+
+    with open(cache_path, 'w') as cache_file:
+        json.dump(validated, cache_file)
+    return missing_files, line_count_issues, failed_task_ids
+
+def _check_shards(output_dir, ranges, task_ids):
+    """
+    Finds the tasks with no output, or an output with the wrong line count, in the output shards
+    for legion_check. Outputs are named after the per-task files they replace.
+    """
+    missing_files = []
+    line_count_issues = []
+    failed_task_ids = []
+    outputs, damaged = index_shards(output_dir, ranges)
+    if damaged:
+        print(f"Warning: skipped {damaged} damaged records in the output shards.")
+    for task_id in task_ids or range(1, len(ranges) + 1):
+        k_start, k_finish = ranges[task_id - 1]
+        file_name = f"output{str(task_id).zfill(5)}.txt"
+        if task_id not in outputs:
+            missing_files.append(file_name)
+            failed_task_ids.append(task_id)
+        elif outputs[task_id][3] != 1 + k_finish - k_start + 1:
+            line_count_issues.append((file_name, outputs[task_id][3]))
+            failed_task_ids.append(task_id)
+    return missing_files, line_count_issues, failed_task_ids
+
+def legion_check(output_dir, n_points, logfile=None, points_per_task=1, workers=CHECK_WORKERS, task_ids=None, sharded=False):
+    """
+    Checks the output of a Legion SRP job.
+
+    The output directory is listed once with os.scandir. Files whose size and mtime match a
+    previous successful check (recorded in CHECK_CACHE_FILE in the output directory) are not
+    re-read; the rest have their lines counted concurrently on a thread pool. Sharded outputs
+    are checked from the shard index (see index_shards), which reads each shard once.
+
+    :param output_dir: Directory where output files are stored.
+    :param n_points: Total number of spiral points submitted.
+    :param logfile: Optional log file to write results to.
+    :param points_per_task: Number of spiral points computed by each array task.
+    :param workers: Number of threads used to count lines.
+    :param task_ids: Only check these tasks (default: all of them).
+    :param sharded: The tasks appended their outputs to shards (see index_shards) instead of
+        writing one file each.
+    :return: Sorted list of SGE task IDs whose output is missing or malformed.
+    """
+    ranges = task_ranges(n_points, points_per_task)
+    if sharded:
+        missing_files, line_count_issues, failed_task_ids = _check_shards(output_dir, ranges, task_ids)
+    else:
+        missing_files, line_count_issues, failed_task_ids = _check_output_files(output_dir, ranges, task_ids, workers)
+    failed_task_ids.sort()
+    line_count_issues.sort()
+
+    # Log results
+    log_lines = [
+        f"Number of output files returned: {len(task_ids or ranges) - len(missing_files)}",
+        f"Missing files: {missing_files}",
+        f"Files with incorrect line count: {line_count_issues}",
+        f"Task IDs to resubmit: {format_task_ids(failed_task_ids)}"
+    ]
+    if logfile:
+        with open(logfile, 'w') as log_file:
+            log_file.write('\n'.join(log_lines))
+    else:
+        for line in log_lines:
+            print(line)
+
+    # Summary with clearer success message
+    if not missing_files and not line_count_issues:
+        success_message = "All checks passed successfully. No missing files, no repeated spiral points, and no error entries found."
+        print(success_message)
+        if logfile:
+            with open(logfile, 'a') as log_file:
+                log_file.write('\n' + success_message)
+    else:
+        summary = "There is a problem with one or more output files."
+        print(summary)
+        if logfile:
+            with open(logfile, 'a') as log_file:
+                log_file.write('\n' + summary)
+
+    return failed_task_ids
+
+def read_metrics_records(metrics_dir):
+    """
+    Reads the per-task metrics records written by the job script or the local backend.
+
+    Sharded campaigns append their records, one JSON object per line, to metricsNNN.jsonl
+    files; a task's later records supersede its earlier ones.
+
+    :return: Dict of task ID to record; unreadable records (e.g. a task killed mid-write) are skipped.
+    """
+    records = {}
+    if not os.path.isdir(metrics_dir):
+        return records
+    with os.scandir(metrics_dir) as entries:
+        paths = sorted(entry.path for entry in entries if entry.name.startswith("metrics") and entry.name.endswith((".json", ".jsonl")))
+    for path in paths:
+        try:
+            with open(path, 'r') as file:
+                lines = file.readlines()
+        except OSError:
+            continue
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record["task_id"]] = record
+    return records
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+def failure_cause(record):
+    """
+    Classifies a metrics record as "ok" or a short failure cause.
+    """
+    if record.get("status"):
+        # Keep local statuses groupable: "exit code 1: <stderr>" -> "exit code 1"
+        return record["status"].split(":")[0]
+    return "ok" if record.get("exit_code") == 0 else f"exit code {record.get('exit_code')}"
+
+def campaign_report(metrics_dir, n_points, points_per_task=1, failed_task_ids=(), logfile=None, task_ids=None):
+    """
+    Summarises the metrics records of a campaign: throughput, run time percentiles, stragglers,
+    slow nodes and failure causes.
+
+    A task counts as failed if its record says so or if it is in failed_task_ids (from legion_check);
+    tasks that failed without a record were most likely killed by SGE, e.g. for exceeding h_rt.
+
+    :param metrics_dir: Directory holding the metricsNNNNN.json records.
+    :param n_points: Total number of spiral points.
+    :param points_per_task: Number of spiral points computed by each array task.
+    :param failed_task_ids: Task IDs whose output is missing or malformed.
+    :param logfile: Optional file to write the report to.
+    :param task_ids: The task IDs submitted (default: all of them).
+    :return: Dict of the aggregated figures.
+    """
+    ranges = task_ranges(n_points, points_per_task)
+    task_ids = task_ids or range(1, len(ranges) + 1)
+    records = read_metrics_records(metrics_dir)
+    failed_task_ids = set(failed_task_ids)
+
+    causes = Counter()
+    completed = []
+    for task_id in task_ids:
+        record = records.get(task_id)
+        if record is None:
+            if task_id in failed_task_ids:
+                causes["no metrics record (not run yet, or killed)"] += 1
+            continue
+        cause = failure_cause(record)
+        if cause == "ok" and task_id in failed_task_ids:
+            cause = "exited cleanly with incomplete output"
+        if cause != "ok":
+            causes[cause] += 1
+            continue
+        k_start, k_finish = ranges[task_id - 1]
+        completed.append((task_id, record, record["end"] - record["start"], k_finish - k_start + 1))
+
+    report = {
+        "tasks": len(task_ids),
+        "records": len(records),
+        "completed": len(completed),
+        "failure_causes": dict(causes.most_common()),
+    }
+    log_lines = [
+        f"Tasks: {len(task_ids)}, metrics records: {len(records)}, completed: {len(completed)}, failed: {sum(causes.values())}",
+    ]
+    if completed:
+        runtimes = sorted(elapsed for _, _, elapsed, _ in completed)
+        seconds_per_point = {task_id: elapsed / points for task_id, _, elapsed, points in completed}
+        median_per_point = statistics.median(seconds_per_point.values())
+        wall = max(record["end"] for _, record, _, _ in completed) - min(record["start"] for _, record, _, _ in completed)
+        points_done = sum(points for _, _, _, points in completed)
+        rss = sorted(record["max_rss_kb"] for _, record, _, _ in completed if record.get("max_rss_kb"))
+
+        stragglers = sorted(((task_id, record.get("host"), seconds_per_point[task_id]) for task_id, record, _, _ in completed
+                             if seconds_per_point[task_id] > STRAGGLER_FACTOR * median_per_point), key=lambda item: -item[2])
+        by_host = defaultdict(list)
+        for task_id, record, _, _ in completed:
+            by_host[record.get("host")].append(seconds_per_point[task_id])
+        slow_nodes = sorted(((host, statistics.median(times), len(times)) for host, times in by_host.items()
+                             if statistics.median(times) > SLOW_NODE_FACTOR * median_per_point), key=lambda item: -item[1])
+
+        report.update({
+            "points_per_hour": points_done / wall * 3600 if wall > 0 else None,
+            "runtime_percentiles": {f"p{p}": percentile(runtimes, p / 100) for p in (50, 90, 99, 100)},
+            "median_seconds_per_point": median_per_point,
+            "peak_rss_mb": rss[-1] / 1024 if rss else None,
+            "stragglers": stragglers,
+            "slow_nodes": slow_nodes,
+        })
+        log_lines += [
+            f"Throughput: {points_done} points in {format_walltime(wall)} ({report['points_per_hour'] or 0:.1f} points/hour)",
+            "Task run time (s): " + ", ".join(f"{name} {value:.1f}" for name, value in report["runtime_percentiles"].items()),
+            f"Median time per spiral point: {median_per_point:.2f}s",
+            f"Peak memory: {report['peak_rss_mb']:.0f}MB" if rss else "Peak memory: not recorded",
+            f"Stragglers (> {STRAGGLER_FACTOR:g}x the median time per point): "
+            + (", ".join(f"{task_id} on {host} ({value:.1f}s/point)" for task_id, host, value in stragglers[:20]) or "none"),
+            f"Slow nodes (median > {SLOW_NODE_FACTOR:g}x overall): "
+            + (", ".join(f"{host} ({value:.1f}s/point over {count} tasks)" for host, value, count in slow_nodes) or "none"),
+        ]
+    log_lines.append("Failure causes: " + (", ".join(f"{cause}: {count}" for cause, count in causes.most_common()) or "none"))
+
+    if logfile:
+        with open(logfile, 'w') as log_file:
+            log_file.write('\n'.join(log_lines) + '\n')
+    for line in log_lines:
+        print(line)
+    return report
+
+def output_row_key(line):
+    """
+    Returns the (Sun_lat, Sun_lon) sort key of an output row, or None if the row is malformed.
+
+    A row is well formed if it has one numeric value for every column of COMBINED_HEADER and
+    finite Sun_lat/Sun_lon values.
+    """
+    fields = line.split(',')
+    if len(fields) != COMBINED_HEADER.count(',') + 1:
+        return None
+    try:
+        values = [float(field) for field in fields]
+    except ValueError:
+        return None
+    if not (math.isfinite(values[0]) and math.isfinite(values[1])):
+        return None
+    return values[0], values[1]
+
+def _write_sorted_run(rows, run_dir):
+    """
+    Sorts (key, line) pairs in memory and writes the lines to a new run file.
+    """
+    rows.sort(key=lambda row: row[0])
+    run_file = tempfile.NamedTemporaryFile('w', dir=run_dir, suffix=".run", delete=False)
+    with run_file:
+        run_file.writelines(line for _, line in rows)
+    return run_file.name
+
+def _merged_lines(run_paths):
+    """
+    k-way merges sorted run files, streaming one line per run at a time.
+    """
+    run_files = [open(path, 'r') for path in run_paths]
+    try:
+        yield from heapq.merge(*run_files, key=output_row_key)
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+def _merge_runs(run_paths, output_file):
+    """
+    k-way merges sorted run files into an open output file.
+    """
+    output_file.writelines(_merged_lines(run_paths))
+
+def npy_header(n_rows):
+    """
+    Builds a NumPy .npy (v1.0) header for n_rows records of NPY_FIELDS as little-endian float64.
+
+    The header is padded to a fixed size, so it can be written before the row count is known
+    and patched in place afterwards.
+    """
+    descr = ", ".join(f"('{name}', '<f8')" for name in NPY_FIELDS)
+    header = f"{{'descr': [{descr}], 'fortran_order': False, 'shape': ({n_rows},), }}"
+    width = len(header) - len(str(n_rows)) + 20
+    total = -(-(10 + width + 1) // 64) * 64
+    header = header.ljust(total - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+def _tee_to_npy(lines, binary_file):
+    """
+    Yields lines unchanged while packing each one as a float64 record into binary_file.
+
+    The caller must rewrite the header with the final row count once the lines are consumed.
+    """
+    buffer = bytearray()
+    for rows, line in enumerate(lines, start=1):
+        buffer += NPY_ROW.pack(*map(float, line.split(',')))
+        if rows % NPY_FLUSH_ROWS == 0:
+            binary_file.write(buffer)
+            buffer.clear()
+        yield line
+    binary_file.write(buffer)
+
+def _sorted_runs(outputs, run_dir, reject_file, max_rows_in_memory=COMBINE_RUN_ROWS):
+    """
+    Reads the rows of task outputs into sorted run files, spilling a run whenever
+    max_rows_in_memory rows are buffered. Malformed rows go to reject_file.
+
+    :param outputs: List of (output name, lines) pairs, where lines iterates over the output
+        file's lines, header included (see _file_lines and _shard_output_lines).
+    :return: Tuple of (run file paths, number of rows read, number of rows rejected).
+    """
+    run_paths = []
+    rows = []
+    combined_rows = 0
+    rejected_rows = 0
+    for file_name, lines in outputs:
+        lines = iter(lines)
+        next(lines, None)  # Skip header line
+        for line in lines:
+            if not line.strip():
+                continue
+            if not line.endswith('\n'):
+                line += '\n'
+            key = output_row_key(line)
+            if key is None:
+                reject_file.write(f"{file_name}: {line}")
+                rejected_rows += 1
+                continue
+            rows.append((key, line))
+            combined_rows += 1
+            if len(rows) >= max_rows_in_memory:
+                run_paths.append(_write_sorted_run(rows, run_dir))
+                rows = []
+    if rows:
+        run_paths.append(_write_sorted_run(rows, run_dir))
+    return run_paths, combined_rows, rejected_rows
+
+def _reduce_runs(run_paths, run_dir):
+    """
+    Merges groups of runs until there are few enough to merge all at once.
+    """
+    while len(run_paths) > COMBINE_MERGE_FAN_IN:
+        merged_paths = []
+        for start in range(0, len(run_paths), COMBINE_MERGE_FAN_IN):
+            group = run_paths[start:start + COMBINE_MERGE_FAN_IN]
+            merged_file = tempfile.NamedTemporaryFile('w', dir=run_dir, suffix=".run", delete=False)
+            with merged_file:
+                _merge_runs(group, merged_file)
+            for path in group:
+                os.remove(path)
+            merged_paths.append(merged_file.name)
+        run_paths = merged_paths
+    return run_paths
+
+def legion_combine(output_dir, combined_output_file, expected_files, max_rows_in_memory=COMBINE_RUN_ROWS, binary_output_file=None, task_ids=None, sharded_ranges=None):
+    """
+    Combines SRP output files into a single text file sorted by (Sun_lat, Sun_lon).
+
+    The outputs are streamed through an external merge sort so memory use is bounded by
+    max_rows_in_memory rather than by the size of the campaign: rows are sorted in runs that
+    are spilled to temporary files next to the combined output, then k-way merged. Malformed
+    rows are written, prefixed with their source file name, to a *_rejects.txt file alongside
+    the combined output instead of breaking the sort.
+
+    If binary_output_file is given, the same sorted rows are also written there as a NumPy .npy
+    structured array with one float64 field per column, which can be opened without parsing
+    via np.load(path, mmap_mode='r'). NumPy is not needed to write it.
+
+    :param output_dir: Directory where output files are stored.
+    :param combined_output_file: File path for the combined output.
+    :param expected_files: Number of expected output files (array tasks); each may hold several rows.
+    :param max_rows_in_memory: Maximum number of rows held in memory while sorting.
+    :param binary_output_file: Optional .npy file path for a binary copy of the combined output.
+    :param task_ids: Only combine the outputs of these tasks (default: 1..expected_files).
+    :param sharded_ranges: For tasks that appended their outputs to shards, the task layout (as
+        returned by task_ranges). The shards are then indexed in one pass, and each task's
+        output is read back at its indexed offset.
+    :return: Tuple of (number of rows combined, number of rows rejected).
+    """
+    reject_file_path = os.path.splitext(combined_output_file)[0] + "_rejects.txt"
+    run_dir = tempfile.mkdtemp(prefix="combine_", dir=os.path.dirname(os.path.abspath(combined_output_file)))
+
+    try:
+        if sharded_ranges:
+            shard_outputs = index_shards(output_dir, sharded_ranges)[0]
+            found = []
+            for i in task_ids or range(1, expected_files + 1):
+                if i in shard_outputs:
+                    found.append(i)
+                else:
+                    print(f"Warning: No output for task {i} in the shards.")
+            output_files = _shard_output_lines(shard_outputs, found)
+        else:
+            output_files = []
+            for i in task_ids or range(1, expected_files + 1):
+                file_name = f"output{str(i).zfill(5)}.txt"
+                file_path = os.path.join(output_dir, file_name)
+                if not os.path.exists(file_path):
+                    print(f"Warning: File {file_path} not found.")
+                    continue
+                output_files.append((file_name, _file_lines(file_path)))
+        with open(reject_file_path, 'w') as reject_file:
+            run_paths, combined_rows, rejected_rows = _sorted_runs(output_files, run_dir, reject_file, max_rows_in_memory)
+        run_paths = _reduce_runs(run_paths, run_dir)
+
+        # Write combined data to a file
+        with open(combined_output_file, 'w') as output_file:
+            output_file.write(COMBINED_HEADER)
+            if binary_output_file is None:
+                _merge_runs(run_paths, output_file)
+            else:
+                with open(binary_output_file, 'wb') as binary_file:
+                    binary_file.write(npy_header(0))
+                    output_file.writelines(_tee_to_npy(_merged_lines(run_paths), binary_file))
+                    binary_file.seek(0)
+                    binary_file.write(npy_header(combined_rows))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    if rejected_rows:
+        print(f"Warning: {rejected_rows} malformed rows were written to {reject_file_path}.")
+    else:
+        os.remove(reject_file_path)
+    return combined_rows, rejected_rows
+
+def read_npy_rows(binary_file_path):
+    """
+    Streams the records of a .npy file written by legion_combine as tuples of floats.
+    """
+    with open(binary_file_path, 'rb') as binary_file:
+        binary_file.seek(len(npy_header(0)))
+        while True:
+            chunk = binary_file.read(NPY_ROW.size * NPY_FLUSH_ROWS)
+            if not chunk:
+                break
+            yield from NPY_ROW.iter_unpack(chunk)
+
+def _write_npy_rows(binary_file_path, rows):
+    """
+    Writes rows (tuples of floats) to a .npy file via a temporary file that replaces it atomically.
+
+    :return: Number of rows written.
+    """
+    tmp_path = f"{binary_file_path}.{os.getpid()}.tmp"
+    n_rows = 0
+    with open(tmp_path, 'wb') as binary_file:
+        binary_file.write(npy_header(0))
+        buffer = bytearray()
+        for n_rows, row in enumerate(rows, start=1):
+            buffer += NPY_ROW.pack(*row)
+            if n_rows % NPY_FLUSH_ROWS == 0:
+                binary_file.write(buffer)
+                buffer.clear()
+        binary_file.write(buffer)
+        binary_file.seek(0)
+        binary_file.write(npy_header(n_rows))
+    os.replace(tmp_path, binary_file_path)
+    return n_rows
+
+def incremental_combine(output_dir, binary_output_file, n_points, points_per_task=1, max_rows_in_memory=COMBINE_RUN_ROWS, sharded=False):
+    """
+    Merges only the outputs completed since the last call into a sorted binary store.
+
+    The store is a .npy file in the same format as legion_combine's binary output, sorted by
+    (Sun_lat, Sun_lon). A manifest (COMBINE_MANIFEST_FILE in the output directory) records the
+    size and mtime of every output merged so far. Each call lists the output directory once,
+    reads only complete outputs that are not in the manifest, sorts their rows and streams them
+    together with the existing store into a new store. Outputs still being written (wrong line
+    count) are left for a later call. If a merged output has changed or disappeared since, the
+    store is rebuilt from scratch. Use write_csv_from_store to produce the CSV.
+
+    Sharded outputs are tracked by the location of each task's record instead, so appends to a
+    shard do not invalidate the outputs already merged from it; a resubmitted task's newer
+    complete record does. Every call indexes the shards in one pass, then reads only the new
+    records back at their offsets.
+
+    :param output_dir: Directory where output files are stored.
+    :param binary_output_file: Path of the .npy store.
+    :param n_points: Total number of spiral points.
+    :param points_per_task: Number of spiral points computed by each array task.
+    :param max_rows_in_memory: Maximum number of new rows held in memory while sorting.
+    :param sharded: The tasks appended their outputs to shards instead of writing one file each.
+    :return: Tuple of (rows added, rows in the store, rows rejected).
+    """
+    manifest_path = os.path.join(output_dir, COMBINE_MANIFEST_FILE)
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        manifest = {"rows": 0, "files": {}}
+    # A store that is missing or does not match the manifest cannot be appended to
+    expected_size = len(npy_header(0)) + manifest["rows"] * NPY_ROW.size
+    if not os.path.exists(binary_output_file) or os.path.getsize(binary_output_file) != expected_size:
+        manifest = {"rows": 0, "files": {}}
+
+    ranges = task_ranges(n_points, points_per_task)
+    if sharded:
+        shard_outputs = index_shards(output_dir, ranges)[0]
+        signatures = {f"output{str(task_id).zfill(5)}.txt": [os.path.basename(path), offset, length]
+                      for task_id, (path, offset, length, _) in shard_outputs.items()}
+        changed = any(signatures.get(name) != signature for name, signature in manifest["files"].items())
+    else:
+        with os.scandir(output_dir) as entries:
+            listing = {entry.name: entry for entry in entries if entry.name.startswith("output") and entry.name.endswith(".txt")}
+        changed = any(name not in listing or [listing[name].stat().st_size, listing[name].stat().st_mtime_ns] != signature
+                      for name, signature in manifest["files"].items())
+
+    merged = manifest["files"]
+    if changed:
+        print("Merged outputs have changed since the last combine; rebuilding the store.")
+        merged = {}
+        manifest = {"rows": 0, "files": merged}
+
+    new_files = []
+    new_task_ids = []
+    for task_id, (k_start, k_finish) in enumerate(ranges, start=1):
+        file_name = f"output{str(task_id).zfill(5)}.txt"
+        if file_name in merged:
+            continue
+        if sharded:
+            output = shard_outputs.get(task_id)
+            if output is not None and output[3] == 1 + k_finish - k_start + 1:
+                new_files.append((file_name, None, signatures[file_name]))
+                new_task_ids.append(task_id)
+            continue
+        entry = listing.get(file_name)
+        if entry is None or count_lines(entry.path) != 1 + k_finish - k_start + 1:
+            continue
+        stat = entry.stat()
+        new_files.append((file_name, _file_lines(entry.path), [stat.st_size, stat.st_mtime_ns]))
+    if not new_files:
+        print(f"No new complete outputs; the store holds {manifest['rows']} rows.")
+        return 0, manifest["rows"], 0
+
+    reject_file_path = os.path.splitext(binary_output_file)[0] + "_rejects.txt"
+    run_dir = tempfile.mkdtemp(prefix="combine_", dir=os.path.dirname(os.path.abspath(binary_output_file)))
+    try:
+        # Rejects accumulate across calls, and start afresh with the store
+        with open(reject_file_path, 'a' if merged else 'w') as reject_file:
+            outputs = _shard_output_lines(shard_outputs, new_task_ids) if sharded else [(name, lines) for name, lines, _ in new_files]
+            run_paths, added_rows, rejected_rows = _sorted_runs(outputs, run_dir, reject_file, max_rows_in_memory)
+        run_paths = _reduce_runs(run_paths, run_dir)
+        new_rows = (tuple(map(float, line.split(','))) for line in _merged_lines(run_paths))
+        existing_rows = read_npy_rows(binary_output_file) if manifest["rows"] else iter(())
+        total_rows = _write_npy_rows(binary_output_file, heapq.merge(existing_rows, new_rows, key=lambda row: (row[0], row[1])))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    merged.update((name, signature) for name, _, signature in new_files)
+    manifest.update({"rows": total_rows, "files": merged})
+    with open(manifest_path + ".tmp", 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    if rejected_rows:
+        print(f"Warning: {rejected_rows} malformed rows were written to {reject_file_path}.")
+    elif os.path.exists(reject_file_path) and os.path.getsize(reject_file_path) == 0:
+        os.remove(reject_file_path)
+    print(f"Merged {len(new_files)} new outputs ({added_rows} rows); the store holds {total_rows} rows from {len(merged)} outputs.")
+    return added_rows, total_rows, rejected_rows
+
+def write_csv_from_store(binary_output_file, combined_output_file):
+    """
+    Writes the rows of a binary store as a combined CSV with COMBINED_HEADER.
+
+    :return: Number of rows written.
+    """
+    tmp_path = f"{combined_output_file}.{os.getpid()}.tmp"
+    row_format = ",".join(["%r"] * len(NPY_FIELDS)) + "\n"
+    n_rows = 0
+    with open(tmp_path, 'w') as output_file:
+        output_file.write(COMBINED_HEADER)
+        batch = []
+        for n_rows, row in enumerate(read_npy_rows(binary_output_file), start=1):
+            batch.append(row_format % row)
+            if len(batch) >= NPY_FLUSH_ROWS:
+                output_file.writelines(batch)
+                batch.clear()
+        output_file.writelines(batch)
+    os.replace(tmp_path, combined_output_file)
+    return n_rows
+
+def merge_stores(store_paths, binary_output_file):
+    """
+    Merges sorted .npy stores into one, keeping a single row for directions present in several.
+
+    :return: Number of rows written.
+    """
+    merged = heapq.merge(*(read_npy_rows(path) for path in store_paths), key=lambda row: (row[0], row[1]))
+    return _write_npy_rows(binary_output_file, _unique_directions(merged))
+
+def _unique_directions(rows):
+    previous = None
+    for row in rows:
+        if row[:2] != previous:
+            yield row
+        previous = row[:2]
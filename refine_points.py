@@ -0,0 +1,108 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from interpolate_grid import to_unit_vectors
+
+LOO_NEIGHBORS = 32
+LOO_BATCH_SIZE = 2000
+# Predicted spiral directions must match the observed ones to within this angle
+SPIRAL_MATCH_TOLERANCE_DEG = 0.05
+
+def spiral_directions(n_points, family='saff', lat_sign=1, lon_sign=1):
+    """
+    Returns (lat, lon) in degrees of spiral points 1..n_points.
+
+    family='saff' is the Saff & Kuijlaars generalised spiral; 'fibonacci' advances the
+    longitude by the golden angle. The signs select the orientation convention.
+    """
+    k = np.arange(1, n_points + 1, dtype=float)
+    if family == 'saff':
+        h = -1 + 2 * (k - 1) / max(n_points - 1, 1)
+        step = np.zeros(n_points)
+        inner = slice(1, n_points - 1)
+        step[inner] = 3.6 / np.sqrt(n_points) / np.sqrt(1 - h[inner] ** 2)
+        phi = np.cumsum(step)
+        phi[-1] = 0.0
+    else:
+        h = -1 + (2 * k - 1) / n_points
+        phi = k * np.pi * (3 - np.sqrt(5))
+    lat = lat_sign * np.degrees(np.arcsin(np.clip(h, -1, 1)))
+    lon = (lon_sign * np.degrees(phi) + 180) % 360 - 180
+    return lat, lon
+
+def match_spiral_convention(lat, lon, n_points):
+    """
+    Finds the spiral convention whose n_points directions reproduce the observed ones.
+
+    Raises ValueError if none matches to SPIRAL_MATCH_TOLERANCE_DEG, since the refinement points
+    could not then be placed reliably.
+    """
+    observed = to_unit_vectors(lat, lon)
+    best = None
+    for family in ('saff', 'fibonacci'):
+        for lat_sign in (1, -1):
+            for lon_sign in (1, -1):
+                tree = cKDTree(to_unit_vectors(*spiral_directions(n_points, family, lat_sign, lon_sign)))
+                distance, _ = tree.query(observed)
+                error = np.degrees(2 * np.arcsin(np.clip(np.median(distance) / 2, 0, 1)))
+                if best is None or error < best[0]:
+                    best = (error, {'family': family, 'lat_sign': lat_sign, 'lon_sign': lon_sign})
+    if best[0] > SPIRAL_MATCH_TOLERANCE_DEG:
+        raise ValueError(f"The observed directions do not match a known {n_points} point spiral "
+                         f"(closest is {best[0]:.3g} deg off); cannot place refinement points.")
+    return best[1]
+
+def _thin_plate(r):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(r > 0, r ** 2 * np.log(r), 0.0)
+
+def leave_one_out_errors(lat, lon, values, neighbors=LOO_NEIGHBORS, batch_size=LOO_BATCH_SIZE):
+    """
+    Estimates the interpolation error at every point by predicting it from its nearest
+    neighbours alone.
+
+    Each prediction is a local thin plate spline fit (with a linear polynomial term) to the
+    neighbours on the unit sphere, the same kind of fit interpolate_grid uses for large inputs.
+    The local systems are solved in batches.
+
+    :return: Array of the norm of the prediction error (same units as values), one per point.
+    """
+    points = to_unit_vectors(lat, lon)
+    values = np.asarray(values, dtype=float)
+    neighbors = min(int(neighbors), len(points) - 1)
+    _, index = cKDTree(points).query(points, k=neighbors + 1)
+    # The nearest point is the point itself
+    index = index[:, 1:]
+
+    errors = np.empty(len(points))
+    size = neighbors + 4
+    for start in range(0, len(points), batch_size):
+        stop = min(start + batch_size, len(points))
+        centre = points[start:stop, None, :]
+        local = points[index[start:stop]] - centre
+        scale = np.linalg.norm(local, axis=2).max(axis=1)[:, None, None]
+        local = local / scale
+
+        system = np.zeros((stop - start, size, size))
+        system[:, :neighbors, :neighbors] = _thin_plate(np.linalg.norm(local[:, :, None, :] - local[:, None, :, :], axis=3))
+        system[:, :neighbors, neighbors] = 1.0
+        system[:, :neighbors, neighbors + 1:] = local
+        system[:, neighbors:, :neighbors] = np.swapaxes(system[:, :neighbors, neighbors:], 1, 2)
+        rhs = np.zeros((stop - start, size, values.shape[1]))
+        rhs[:, :neighbors] = values[index[start:stop]]
+        coefficients = np.linalg.solve(system, rhs)
+
+        # Evaluate at the centre, where the local coordinates are zero
+        weights = _thin_plate(np.linalg.norm(local, axis=2))
+        prediction = np.einsum('bn,bnv->bv', weights, coefficients[:, :neighbors]) + coefficients[:, neighbors]
+        errors[start:stop] = np.linalg.norm(prediction - values[start:stop], axis=1)
+    return errors
+
+def select_refinement_points(lat, lon, flagged, n_fine, convention):
+    """
+    Returns the spiral indices (1-based) of an n_fine point spiral whose nearest existing point
+    is flagged, i.e. the new points falling in the flagged points' neighbourhoods.
+    """
+    fine = to_unit_vectors(*spiral_directions(n_fine, **convention))
+    _, nearest = cKDTree(to_unit_vectors(lat, lon)).query(fine)
+    return np.flatnonzero(np.asarray(flagged)[nearest]) + 1
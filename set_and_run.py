@@ -1,260 +1,584 @@
 import os
-import subprocess
-import shutil
+import sys
+import math
 import time
+import argparse
 
-HOME_DIR = os.path.expanduser("~")
-SCRATCH_DIR = os.path.join(HOME_DIR, "Scratch")
-SRP_TRR_CLASSIC_PATH = os.path.join(HOME_DIR, "srp_trr_classic/bin/srp_trr_classic")
-RES_DIR = os.path.join(HOME_DIR, "res")
+from backends import BACKENDS, sge_job_id, sge_accounting
+from myriad_core import (
+    HOME_DIR, SCRATCH_DIR, SRP_TRR_CLASSIC_PATH, RES_DIR, CAMPAIGN_FILE, COMBINE_MANIFEST_FILE, DEFAULT_H_RT, DEFAULT_MEM, TASKS_PER_SHARD,
+    mission_paths, generate_directory_structure, task_ranges, parse_walltime, format_walltime,
+    points_per_task_for_walltime, write_campaign_state, read_campaign_state, update_campaign_state,
+    record_resubmission, generate_parameter_files, setup_environment, format_task_ids, parse_task_ids,
+    legion_check, legion_combine, incremental_combine, write_csv_from_store, merge_stores, read_parameter_file,
+    read_metrics_records, failure_cause, campaign_report,
+)
+try:
+    import spacecraft_model
+    import cost_model
+except ImportError:  # NumPy is not installed; submit skips the model check and cost model
+    spacecraft_model = cost_model = None
+try:
+    import numpy as np
+    import refine_points
+except ImportError:  # NumPy, SciPy or pandas is not installed; refine is unavailable
+    np = refine_points = None
 
-def generate_directory_structure(base_dir, mission):
+DEFAULT_REFINE_TOLERANCE = 0.01
+DEFAULT_REFINE_FACTOR = 4
+REFINE_STARTUP_MARGIN_SECONDS = 600
+
+CLUSTER_LOCATIONS = {
+    "home_dir": HOME_DIR,
+    "scratch_dir": SCRATCH_DIR,
+    "res_dir": RES_DIR,
+    "srp_trr_classic_path": SRP_TRR_CLASSIC_PATH,
+}
+
+def _task_layout(paths, n_points=None, points_per_task=1):
+    """
+    Returns (n_points, points_per_task) from campaign.json, falling back to the given values for
+    submissions made before the layout was recorded.
+    """
+    state = read_campaign_state(paths["campaign_dir"])
+    if state is not None:
+        return state["n_points"], state["points_per_task"]
+    if n_points is None:
+        raise ValueError(f"No {CAMPAIGN_FILE} in {paths['campaign_dir']}; the number of spiral points must be given.")
+    return n_points, points_per_task
+
+def _submitted_task_ids(paths):
     """
-    Generates the directory structure for the given mission.
+    Returns the task IDs a campaign submitted, or None if it submitted all of its tasks.
     """
-    output_dir = os.path.join(base_dir, mission, "spiralPoints", "outputFiles")
-    param_dir = os.path.join(base_dir, mission, "spiralPoints", "paramFiles")
+    state = read_campaign_state(paths["campaign_dir"])
+    if state is None or not state.get("task_ids"):
+        return None
+    return parse_task_ids(state["task_ids"])
 
-    os.makedirs(output_dir, exist_ok=True)
-    os.makedirs(param_dir, exist_ok=True)
+def _tasks_per_shard(paths):
+    """
+    Returns the number of tasks per output shard of a campaign, or None if its tasks write one
+    output file each.
+    """
+    state = read_campaign_state(paths["campaign_dir"])
+    return state.get("tasks_per_shard") if state else None
 
-    return output_dir, param_dir
+def _job_script_name(refinement_pass=None, attempt=None):
+    name = "job_array_script"
+    if refinement_pass:
+        name += f"_refine{str(refinement_pass).zfill(2)}"
+    if attempt:
+        name += f"_resubmit{str(attempt).zfill(3)}"
+    return name + ".sh"
 
-def generate_parameter_files(template_filename, output_prefix, num_files, model_type, scheme, spacing, sr_option, emissivity):
+def check_model(paths):
     """
-    Generates parameter files based on a template with user-defined settings.
+    Parses and validates a mission's spacecraft model before anything is submitted.
 
-    :param template_filename: Path to the template file.
-    :param output_prefix: Prefix for the output files.
-    :param num_files: Number of parameter files to generate.
+    :return: True if the model has no errors (or NumPy is unavailable to check it).
+    """
+    if spacecraft_model is None:
+        print("NumPy is not available; skipping the spacecraft model check.")
+        return True
+    try:
+        model = spacecraft_model.load_model(paths["spacecraft_model_file"])
+    except OSError as error:
+        print(f"Cannot read the spacecraft model: {error}")
+        return False
+    issues = spacecraft_model.validate_model(model)
+    print(spacecraft_model.model_report(model, issues))
+    return not any(severity == "error" for severity, _, _ in issues)
+
+def submit(mission_id, n_points, mass, model_type, scheme, spacing, sr_option, emissivity, points_per_task=1, target_walltime=None, seconds_per_point=None, shared_params=False, backend="sge", home_dir=HOME_DIR, scratch_dir=SCRATCH_DIR, res_dir=RES_DIR, srp_trr_classic_path=SRP_TRR_CLASSIC_PATH, concurrency=None, timeout=None, skip_model_check=False, auto_size=False, tasks_per_shard=None):
+    """
+    Generates the parameter files for a mission and runs them with the chosen backend.
+
+    :param mission_id: Name of the mission.
+    :param n_points: Total number of spiral points.
+    :param mass: Mass of the spacecraft.
     :param model_type: Type of modeling required (0 for SRP, 1 for SRP+TRR, 2 for TRR).
     :param scheme: Pixel array orientation scheme (0 for EPS angles, 1 for spiral points).
     :param spacing: Pixel spacing of the array.
     :param sr_option: Option to include secondary reflections (Y or N).
     :param emissivity: MLI emissivity for TRR models.
+    :param points_per_task: Number of spiral points computed by each task.
+    :param target_walltime: If given, size points_per_task to fit this wall time (H:MM:SS) instead.
+    :param seconds_per_point: Estimated run time of one spiral point, used with target_walltime;
+        estimated by the cost model if not given.
+    :param shared_params: Write one shared base parameter file plus a range index.
+    :param backend: Name of the execution backend ("sge", "local" or "dry-run").
+    :param concurrency: Number of tasks run at once by the local backend (default: one per CPU).
+    :param timeout: Seconds after which the local backend kills a task.
+    :param skip_model_check: Submit even if the spacecraft model fails validation.
+    :param auto_size: Pick points_per_task, h_rt and mem from the cost model, packing each task
+        up to target_walltime (default cost_model.DEFAULT_TARGET_WALLTIME).
+    :param tasks_per_shard: Have each block of this many tasks append its outputs and metrics
+        records to one shard file instead of writing a file per task; implies shared_params.
+    :return: Number of tasks submitted (0 if the model was rejected).
     """
-    with open(template_filename, 'r') as template_file:
-        template_content = template_file.readlines()
-
-    for file_index in range(1, num_files + 1):
-        output_filename = f"{output_prefix}{str(file_index).zfill(5)}.txt"
-        with open(output_filename, 'w') as output_file:
-            for line in template_content:
-                if line.strip().startswith("model_type"):
-                    output_file.write(f"model_type   = {model_type}\n")
-                elif line.strip().startswith("scheme"):
-                    output_file.write(f"scheme       = {scheme}\n")
-                elif line.strip().startswith("spacing"):
-                    output_file.write(f"spacing      = {spacing}\n")
-                elif line.strip().startswith("sr_option"):
-                    output_file.write(f"sr_option    = {sr_option}\n")
-                elif line.strip().startswith("emissivity"):
-                    output_file.write(f"emissivity   = {emissivity}\n")
-                elif line.strip().startswith("k_start"):
-                    output_file.write(f"k_start      = {file_index}\n")
-                elif line.strip().startswith("k_finish"):
-                    output_file.write(f"k_finish     = {file_index}\n")
-                elif line.strip().startswith("n_points"):
-                    output_file.write(f"n_points     = {num_files}\n")
-                else:
-                    output_file.write(line)
-
-def setup_environment(mission, mass, res_dir, home_dir):
+    paths = mission_paths(mission_id, home_dir, scratch_dir)
+    if not skip_model_check and not check_model(paths):
+        print("The spacecraft model has errors; fix it or pass --skip-model-check to submit anyway.")
+        return 0
+
+    h_rt, mem, cost, cost_sized = DEFAULT_H_RT, DEFAULT_MEM, None, False
+    if cost_model is not None and os.access(paths["spacecraft_model_file"], os.R_OK):
+        cost = cost_model.cost_features(paths["spacecraft_model_file"], spacing, sr_option)
+    if auto_size or (target_walltime and seconds_per_point is None):
+        if cost is None:
+            raise ValueError("Sizing tasks from the cost model needs NumPy and the spacecraft model; give seconds_per_point instead.")
+        plan = cost_model.plan_resources(cost, n_points, target_walltime, seconds_per_point)
+        points_per_task, h_rt, mem = plan["points_per_task"], plan["h_rt"], plan["mem"]
+        cost_sized = seconds_per_point is None
+        print(f"Cost model: about {plan['seconds_per_point']:.3g}s per spiral point; "
+              f"{points_per_task} points per task, h_rt={h_rt}, mem={mem}.")
+    elif target_walltime:
+        points_per_task = points_per_task_for_walltime(target_walltime, seconds_per_point)
+        h_rt = format_walltime(parse_walltime(target_walltime))
+    # Sharded tasks read the shared parameter file too, so no file is written per task
+    shared_params = shared_params or bool(tasks_per_shard)
+    setup_environment(mission_id, str(mass), res_dir, home_dir)
+    generate_directory_structure(scratch_dir, mission_id)
+    param_file_template = os.path.join(res_dir, "parameters_template.txt")
+    num_tasks = generate_parameter_files(param_file_template, os.path.join(paths["param_dir"], "params"), n_points, model_type, scheme, spacing, sr_option, emissivity, points_per_task, shared_params)
+    write_campaign_state(paths["campaign_dir"], n_points, points_per_task, shared_params, h_rt, backend, mem, cost, tasks_per_shard=tasks_per_shard)
+
+    backend_output = BACKENDS[backend]({
+        "srp_trr_classic_path": srp_trr_classic_path,
+        "param_dir": paths["param_dir"],
+        "spacecraft_model_file": paths["spacecraft_model_file"],
+        "output_dir": paths["output_dir"],
+        "metrics_dir": paths["metrics_dir"],
+        "n_points": n_points,
+        "points_per_task": points_per_task,
+        "shared_params": shared_params,
+        "task_ids": None,
+        "tasks_per_shard": tasks_per_shard,
+        "h_rt": h_rt,
+        "mem": mem,
+        "job_script_filename": "job_array_script.sh",
+        "concurrency": concurrency,
+        "timeout": timeout,
+    })
+    update_campaign_state(paths["campaign_dir"], {"submission_output": backend_output, "cost_sized": cost_sized})
+    print(f"Submitted {num_tasks} tasks of up to {points_per_task} spiral points each.")
+    return num_tasks
+
+def check(mission_id, n_points=None, points_per_task=1, home_dir=HOME_DIR, scratch_dir=SCRATCH_DIR, refinement_pass=None):
     """
-    Sets up the environment for UCL SRP force model computation.
+    Checks a mission's outputs and writes {home_dir}/{mission_id}/legion_check_log.txt.
 
-    :param mission: Name of the mission.
-    :param mass: Mass of the spacecraft.
-    :param res_dir: Directory where resources are located.
-    :param home_dir: Home directory path.
+    :param refinement_pass: Check this adaptive refinement pass instead of the initial run.
+    :return: Sorted list of task IDs whose output is missing or malformed.
     """
-    # Create necessary directories
-    mission_dirs = [
-        # [Previous directory setup code remains unchanged]
-    ]
-    for dir_path in mission_dirs:
-        os.makedirs(dir_path, exist_ok=True)
-
-    # Copy parameter file and update spacecraft mass
-    shutil.copy(f"{res_dir}/parameters_template.txt", f"{home_dir}/{mission}/parameters.txt")
-    with open(f"{home_dir}/{mission}/parameters.txt", 'r') as file:
-        lines = file.readlines()
-
-    updated_lines = []
-    mass_line_found = False
-    for line in lines:
-        if "// mass of spacecraft (kg)" in line and not mass_line_found:
-            updated_lines.append(line)  # Keep the comment line
-            mass_line_found = True  # Flag to indicate the mass line is next
-        elif mass_line_found:
-            updated_lines.append(f"mass         = {mass}\n")  # Update the mass value
-            mass_line_found = False  # Reset the flag
-        else:
-            updated_lines.append(line)  # Keep all other lines as they are
+    paths = mission_paths(mission_id, home_dir, scratch_dir, refinement_pass)
+    n_points, points_per_task = _task_layout(paths, n_points, points_per_task)
+    return legion_check(paths["output_dir"], n_points, paths["check_log_file"], points_per_task, task_ids=_submitted_task_ids(paths),
+                        sharded=bool(_tasks_per_shard(paths)))
 
-    with open(f"{home_dir}/{mission}/parameters.txt", 'w') as file:
-        file.writelines(updated_lines)
+def combine(mission_id, n_points=None, points_per_task=1, scratch_dir=SCRATCH_DIR, incremental=False, write_csv=True, refinement_pass=None):
+    """
+    Combines a mission's outputs into outputFiles/combined_output.txt and combined_output.npy.
 
-def convert_line_endings_to_local(filename, output_prefix="local"):
+    :param refinement_pass: Combine this adaptive refinement pass instead of the initial run.
+    :param incremental: Only merge outputs completed since the last incremental combine into
+        combined_output.npy (see myriad_core.incremental_combine).
+    :param write_csv: With incremental, also rewrite combined_output.txt from the updated store.
+    :return: Tuple of (number of rows combined, number of rows rejected).
     """
-    Converts line endings in the file to Unix-style (LF) and writes to a new file.
+    paths = mission_paths(mission_id, scratch_dir=scratch_dir, refinement_pass=refinement_pass)
+    n_points, points_per_task = _task_layout(paths, n_points, points_per_task)
+    combined_output_path = os.path.join(paths["output_dir"], 'combined_output.txt')
+    combined_binary_path = os.path.join(paths["output_dir"], 'combined_output.npy')
+    sharded = bool(_tasks_per_shard(paths))
+    if incremental:
+        _, total_rows, rejected_rows = incremental_combine(paths["output_dir"], combined_binary_path, n_points, points_per_task, sharded=sharded)
+        if write_csv:
+            write_csv_from_store(combined_binary_path, combined_output_path)
+        return total_rows, rejected_rows
 
-    :param filename: The name of the file to be converted.
-    :param output_prefix: The prefix for the output file.
+    # A full combine rewrites the store from every output, complete or not
+    manifest_path = os.path.join(paths["output_dir"], COMBINE_MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    ranges = task_ranges(n_points, points_per_task)
+    return legion_combine(paths["output_dir"], combined_output_path, len(ranges), binary_output_file=combined_binary_path,
+                          task_ids=_submitted_task_ids(paths), sharded_ranges=ranges if sharded else None)
+
+def resubmit(mission_id, backend=None, home_dir=HOME_DIR, scratch_dir=SCRATCH_DIR, srp_trr_classic_path=SRP_TRR_CLASSIC_PATH, concurrency=None, timeout=None, refinement_pass=None):
     """
-    with open(filename, 'r', newline=None) as f:
-        content = f.read()
-    
-    new_content = content.replace('\r\n', '\n').replace('\r', '\n')
-    with open(output_prefix + filename, 'w', newline='\n') as w:
-        w.write(new_content)
-
-def submit_jobs(srp_trr_classic_path, param_files_dir, spacecraft_model_file, output_files_dir, total_jobs=10000):
+    Re-runs the check and runs only the failed or missing tasks again.
+
+    The attempt is recorded in the campaign state file.
+
+    :param mission_id: Name of the mission.
+    :param backend: Name of the execution backend; defaults to the one the mission was submitted with.
+    :param concurrency: Number of tasks run at once by the local backend (default: one per CPU).
+    :param timeout: Seconds after which the local backend kills a task.
+    :param refinement_pass: Resubmit failed tasks of this adaptive refinement pass.
+    :return: List of resubmitted task IDs.
     """
-    Submits a job array to the job scheduler, ensuring correct argument passing.
+    paths = mission_paths(mission_id, home_dir, scratch_dir, refinement_pass)
+    campaign_dir = paths["campaign_dir"]
+    state = read_campaign_state(campaign_dir)
+    if state is None:
+        print(f"No {CAMPAIGN_FILE} found in {campaign_dir}; resubmit the full job with 'submit'.")
+        return []
+
+    failed_task_ids = legion_check(paths["output_dir"], state["n_points"], paths["check_log_file"], state["points_per_task"],
+                                   task_ids=_submitted_task_ids(paths), sharded=bool(state.get("tasks_per_shard")))
+    if not failed_task_ids:
+        print("Nothing to resubmit.")
+        return []
+
+    backend = backend or state.get("backend", "sge")
+    attempt = len(state.get("resubmissions", [])) + 1
+    job_script_filename = _job_script_name(refinement_pass, attempt)
+    backend_output = BACKENDS[backend]({
+        "srp_trr_classic_path": srp_trr_classic_path,
+        "param_dir": paths["param_dir"],
+        "spacecraft_model_file": paths["spacecraft_model_file"],
+        "output_dir": paths["output_dir"],
+        "metrics_dir": paths["metrics_dir"],
+        "n_points": state["n_points"],
+        "points_per_task": state["points_per_task"],
+        "shared_params": state.get("shared_params", False),
+        "task_ids": failed_task_ids,
+        "tasks_per_shard": state.get("tasks_per_shard"),
+        "h_rt": state.get("h_rt", DEFAULT_H_RT),
+        "mem": state.get("mem", DEFAULT_MEM),
+        "job_script_filename": job_script_filename,
+        "task_index_file": os.path.join(campaign_dir, f"resubmit{str(attempt).zfill(3)}_tasks.txt"),
+        "concurrency": concurrency,
+        "timeout": timeout,
+    })
+    record_resubmission(campaign_dir, {
+        "attempt": attempt,
+        "submitted": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "backend": backend,
+        "task_ids": format_task_ids(failed_task_ids),
+        "job_script": os.path.abspath(job_script_filename),
+        "qsub_output": backend_output,
+    })
+    print(f"Resubmitted {len(failed_task_ids)} tasks (attempt {attempt}).")
+    return failed_task_ids
+
+def report(mission_id, home_dir=HOME_DIR, scratch_dir=SCRATCH_DIR, refinement_pass=None):
     """
-    job_script_filename = "job_array_script.sh"
-    
-    # Ensure absolute paths are used for directories and files
-    absolute_output_files_dir = os.path.abspath(output_files_dir)
-    absolute_param_files_dir = os.path.abspath(param_files_dir)
-    absolute_spacecraft_model_file = os.path.abspath(spacecraft_model_file)
-
-    with open(job_script_filename, "w") as file:
-        file.writelines([
-            "#!/bin/bash -l\n",
-            "#$ -S /bin/bash\n",
-            "#$ -l h_rt=5:00:0\n",
-            "#$ -l mem=512M\n",
-            f"#$ -t 1-{total_jobs}\n",
-            "#$ -N srp_trr_job_array\n",
-            f"#$ -wd {absolute_output_files_dir}\n\n",
-            "module unload mkl/10.2.5/035\n",
-            "module unload mpi/qlogic/1.2.7/intel\n",
-            "module unload compilers/intel/11.1/072\n",
-            "module load compilers/gnu/4.1.2\n",
-            "module load mpi/qlogic/1.2.7/gnu\n\n",
-            f"param_file={absolute_param_files_dir}/params$(printf '%05d' $SGE_TASK_ID).txt\n",
-            f"output_file={absolute_output_files_dir}/output$(printf '%05d' $SGE_TASK_ID).txt\n\n",
-            f"{srp_trr_classic_path} $param_file {absolute_spacecraft_model_file} $output_file\n"
-        ])
-
-    subprocess.run(["qsub", job_script_filename])
-
-def legion_check(output_dir, expected_files, logfile=None):
+    Re-runs the check and writes {home_dir}/{mission_id}/campaign_report.txt from the tasks'
+    metrics records.
+
+    :param refinement_pass: Report on this adaptive refinement pass instead of the initial run.
+    :return: Dict of the aggregated figures (see myriad_core.campaign_report).
     """
-    Checks the output of a Legion SRP job.
+    paths = mission_paths(mission_id, home_dir, scratch_dir, refinement_pass)
+    n_points, points_per_task = _task_layout(paths)
+    task_ids = _submitted_task_ids(paths)
+    failed_task_ids = legion_check(paths["output_dir"], n_points, paths["check_log_file"], points_per_task, task_ids=task_ids,
+                                   sharded=bool(_tasks_per_shard(paths)))
+    return campaign_report(paths["metrics_dir"], n_points, points_per_task, failed_task_ids, paths["report_file"], task_ids)
 
-    :param output_dir: Directory where output files are stored.
-    :param expected_files: Number of expected output files.
-    :param logfile: Optional log file to write results to.
+def calibrate(mission_id, home_dir=HOME_DIR, scratch_dir=SCRATCH_DIR, refinement_pass=None):
     """
-    missing_files = []
-    line_count_issues = []
-
-    # Check for missing files
-    for i in range(1, expected_files + 1):
-        file_name = f"output{str(i).zfill(len(str(expected_files)))}.txt"
-        file_path = os.path.join(output_dir, file_name)
-        if not os.path.exists(file_path):
-            missing_files.append(file_name)
-        else:
-            # Check line count
-            with open(file_path, 'r') as file:
-                lines = file.readlines()
-                if len(lines) != 2:
-                    line_count_issues.append((file_name, len(lines)))
-
-    # Log results
-    log_lines = [
-        f"Number of output files returned: {expected_files - len(missing_files)}",
-        f"Missing files: {missing_files}",
-        f"Files with incorrect line count: {line_count_issues}"
-    ]
-    if logfile:
-        with open(logfile, 'w') as log_file:
-            log_file.write('\n'.join(log_lines))
-    else:
-        for line in log_lines:
-            print(line)
-
-    # Summary with clearer success message
-    if not missing_files and not line_count_issues:
-        success_message = "All checks passed successfully. No missing files, no repeated spiral points, and no error entries found."
-        print(success_message)
-        if logfile:
-            with open(logfile, 'a') as log_file:
-                log_file.write('\n' + success_message)
+    Adds the run times and peak memory of a mission's finished tasks to the cost model calibration.
+
+    Timings come from the tasks' metrics records, or from SGE accounting (qacct) for runs
+    submitted before tasks wrote metrics records.
+
+    :param refinement_pass: Calibrate from this adaptive refinement pass instead of the initial run.
+    :return: The calibration sample, or None if no timings were found.
+    """
+    paths = mission_paths(mission_id, home_dir, scratch_dir, refinement_pass)
+    state = read_campaign_state(paths["campaign_dir"])
+    if cost_model is None or state is None or not state.get("cost"):
+        print(f"No cost model features in {CAMPAIGN_FILE}; only missions submitted with NumPy available can be calibrated.")
+        return None
+
+    ranges = task_ranges(state["n_points"], state["points_per_task"])
+    timings = {}
+    for task_id, record in read_metrics_records(paths["metrics_dir"]).items():
+        if failure_cause(record) == "ok" and 1 <= task_id <= len(ranges):
+            k_start, k_finish = ranges[task_id - 1]
+            max_rss_kb = record.get("max_rss_kb")
+            timings[task_id] = (k_finish - k_start + 1, record["end"] - record["start"], max_rss_kb / 1024 if max_rss_kb else None)
+
+    if not timings:
+        # Sparse resubmissions number their array tasks 1..n over the listed task IDs
+        jobs = [(sge_job_id(state.get("submission_output")), None)]
+        for resubmission in state.get("resubmissions", []):
+            task_ids = parse_task_ids(resubmission["task_ids"])
+            contiguous = task_ids[-1] - task_ids[0] + 1 == len(task_ids)
+            jobs.append((sge_job_id(resubmission.get("qsub_output")), None if contiguous else task_ids))
+        for job_id, task_ids in jobs:
+            if job_id is None:
+                continue
+            for record in sge_accounting(job_id):
+                if record["exit_status"] or record["failed"]:
+                    continue
+                task_id = task_ids[record["task_id"] - 1] if task_ids else record["task_id"]
+                k_start, k_finish = ranges[task_id - 1]
+                timings[task_id] = (k_finish - k_start + 1, record["wallclock"], record["maxvmem_mb"])
+
+    sample = cost_model.calibrate(state["cost"], list(timings.values()), os.path.abspath(paths["campaign_dir"]))
+    if sample is None:
+        print("No timings of successful tasks found (no metrics records, and qacct has none for this run).")
     else:
-        summary = "There is a problem with one or more output files."
-        print(summary)
-        if logfile:
-            with open(logfile, 'a') as log_file:
-                log_file.write('\n' + summary)
+        print(f"Calibrated from {sample['tasks']} tasks: {sample['seconds_per_point']:.3g}s per spiral point"
+              + (f", peak memory {sample['peak_mem_mb']:.0f}MB." if sample["peak_mem_mb"] else "."))
+    return sample
 
-def legion_combine(output_dir, combined_output_file, expected_files):
+def refine(mission_id, tolerance=DEFAULT_REFINE_TOLERANCE, factor=DEFAULT_REFINE_FACTOR, points_per_task=1, backend=None, neighbors=None, home_dir=HOME_DIR, scratch_dir=SCRATCH_DIR, res_dir=RES_DIR, srp_trr_classic_path=SRP_TRR_CLASSIC_PATH, concurrency=None, timeout=None):
     """
-    Combines SRP output files into a single text file and sorts them.
+    Runs one adaptive refinement pass: estimates the interpolation error of the points computed
+    so far and submits extra spiral points only where it exceeds the tolerance.
 
-    :param output_dir: Directory where output files are stored.
-    :param combined_output_file: File path for the combined output.
-    :param expected_files: Number of expected output files.
+    The initial run and every earlier pass must be complete. Their outputs are merged into
+    outputFiles/combined_adaptive_output.npy (and .txt), the input for interpolate_grid.py. Each
+    point's error is estimated by leave-one-out: it is predicted from its nearest neighbours alone
+    and compared with the computed value, relative to the RMS acceleration over all points. The
+    pass then takes a spiral factor times denser than the previous one and runs only the points
+    whose nearest existing point is above the tolerance, as a sub-campaign in spiralPoints/refineNN
+    with the initial run's settings. Call refine again once the pass has finished.
+
+    :param mission_id: Name of the mission.
+    :param tolerance: Target leave-one-out error, relative to the RMS acceleration.
+    :param factor: How many times denser each pass's spiral is than the previous one.
+    :param points_per_task: Spiral points per task in the pass; points of a flagged region are
+        spread along the spiral, so larger tasks run many points that were not asked for.
+    :param backend: Name of the execution backend; defaults to the one the mission was submitted with.
+    :param neighbors: Nearest points used for each leave-one-out prediction.
+    :return: Number of tasks submitted (0 if the target accuracy is reached or a pass is unfinished).
     """
-    combined_data = []
-
-    # Read data from each output file
-    for i in range(1, expected_files + 1):
-        file_name = f"output{str(i).zfill(5)}.txt"
-        file_path = os.path.join(output_dir, file_name)
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as file:
-                lines = file.readlines()[1:]  # Skip header line
-                combined_data.extend(lines)
-        else:
-            print(f"Warning: File {file_path} not found.")
+    if refine_points is None:
+        raise ValueError("Adaptive refinement needs NumPy, SciPy and pandas.")
+    paths = mission_paths(mission_id, home_dir, scratch_dir)
+    state = read_campaign_state(paths["campaign_dir"])
+    if state is None:
+        print(f"No {CAMPAIGN_FILE} found in {paths['campaign_dir']}; submit the initial run first.")
+        return 0
+    refinements = state.get("refinements", [])
 
-    # Attempt to sort combined data based on the first column (if it's numeric)
-    try:
-        combined_data.sort(key=lambda x: float(x.split(',')[0]))
-    except ValueError:
-        print("Warning: Unable to sort combined data numerically. Data will be combined as is.")
+    stores = []
+    for previous_pass in range(len(refinements) + 1):
+        pass_paths = mission_paths(mission_id, home_dir, scratch_dir, previous_pass or None)
+        n_points, pass_points_per_task = _task_layout(pass_paths)
+        sharded = bool(_tasks_per_shard(pass_paths))
+        failed_task_ids = legion_check(pass_paths["output_dir"], n_points, pass_paths["check_log_file"], pass_points_per_task,
+                                       task_ids=_submitted_task_ids(pass_paths), sharded=sharded)
+        if failed_task_ids:
+            name = f"Refinement pass {previous_pass}" if previous_pass else "The initial run"
+            print(f"{name} has {len(failed_task_ids)} unfinished tasks; wait for them or resubmit them before refining.")
+            return 0
+        store = os.path.join(pass_paths["output_dir"], "combined_output.npy")
+        incremental_combine(pass_paths["output_dir"], store, n_points, pass_points_per_task, sharded=sharded)
+        stores.append(store)
 
-    # Write combined data to a file
-    with open(combined_output_file, 'w') as output_file:
-        output_file.write("Sun_lat,Sun_lon,acc_X,acc_Y,acc_Z,EPS_angle\n")  # Adding header
-        output_file.writelines(combined_data)
+    adaptive_store = os.path.join(paths["output_dir"], "combined_adaptive_output.npy")
+    merge_stores(stores, adaptive_store)
+    write_csv_from_store(adaptive_store, os.path.join(paths["output_dir"], "combined_adaptive_output.txt"))
 
-def main(mission_id, mode, sc_mass=None, num_jobs=None, model_type=None, scheme=None, spacing=None, sr_option=None, emissivity=None):
-    if mode == "submit":
-        setup_environment(mission_id, str(sc_mass), RES_DIR, HOME_DIR)
-        output_dir, param_dir = generate_directory_structure(SCRATCH_DIR, mission_id)
-        param_file_template = os.path.join(RES_DIR, "parameters_template.txt")
-        generate_parameter_files(param_file_template, os.path.join(param_dir, "params"), num_jobs, model_type, scheme, spacing, sr_option, emissivity)
-        spacecraft_model_file = os.path.join(HOME_DIR, mission_id, f"{mission_id}.txt")
-        submit_jobs(SRP_TRR_CLASSIC_PATH, param_dir, spacecraft_model_file, output_dir, total_jobs=num_jobs)
-        print("Jobs submitted. You can check the job status using 'qstat'.")
-    elif mode == "check" or mode == "combine":
-        output_dir = os.path.join(SCRATCH_DIR, mission_id, "spiralPoints", "outputFiles")
-        if mode == "check":
-            check_log_path = os.path.join(HOME_DIR, mission_id, 'legion_check_log.txt')
-            legion_check(output_dir, num_jobs, check_log_path)
-        elif mode == "combine":
-            combined_output_path = os.path.join(output_dir, 'combined_output.txt')
-            legion_combine(output_dir, combined_output_path, num_jobs)
+    initial = np.load(stores[0])
+    convention = refine_points.match_spiral_convention(initial["Sun_lat"], initial["Sun_lon"], state["n_points"])
+    data = np.load(adaptive_store)
+    values = np.column_stack((data["acc_X"], data["acc_Y"], data["acc_Z"]))
+    errors = refine_points.leave_one_out_errors(data["Sun_lat"], data["Sun_lon"], values, neighbors or refine_points.LOO_NEIGHBORS)
+    relative_errors = errors / np.sqrt(np.mean(np.sum(values ** 2, axis=1)))
+    flagged = relative_errors > tolerance
+    print(f"Leave-one-out error relative to the RMS acceleration over {len(data)} points: median {np.median(relative_errors):.3g}, "
+          f"max {relative_errors.max():.3g}; {flagged.sum()} points above {tolerance:g}.")
+    if not flagged.any():
+        print(f"Target accuracy reached; the adaptive dataset is {adaptive_store}.")
+        return 0
 
-if __name__ == "__main__":
+    refinement_pass = len(refinements) + 1
+    n_fine = (refinements[-1]["n_points"] if refinements else state["n_points"]) * int(factor)
+    selected = refine_points.select_refinement_points(data["Sun_lat"], data["Sun_lon"], flagged, n_fine, convention)
+    task_ids = sorted({(int(k) - 1) // points_per_task + 1 for k in selected})
+
+    # The pass uses the initial run's settings on a denser spiral
+    pass_paths = mission_paths(mission_id, home_dir, scratch_dir, refinement_pass)
+    os.makedirs(pass_paths["output_dir"], exist_ok=True)
+    os.makedirs(pass_paths["param_dir"], exist_ok=True)
+    shared_params = state.get("shared_params", False)
+    settings = read_parameter_file(os.path.join(paths["param_dir"], "params_base.txt" if shared_params else "params00001.txt"))
+    generate_parameter_files(os.path.join(res_dir, "parameters_template.txt"), os.path.join(pass_paths["param_dir"], "params"), n_fine,
+                             settings["model_type"], settings["scheme"], settings["spacing"], settings["sr_option"], settings["emissivity"],
+                             points_per_task, shared_params, task_ids)
+    # Size the pass's wall time like submit does if the cost model's estimate can be trusted (the
+    # model has been calibrated, or it already sized the initial run), or else scale the initial
+    # run's time per point and add back a startup margin, which small tasks need as much as large ones
+    cost = state.get("cost")
+    if cost_model is not None and cost and (state.get("cost_sized") or cost_model.is_calibrated(cost)):
+        h_rt = cost_model.walltime_for_points(points_per_task, cost_model.estimate_seconds_per_point(cost))
+    else:
+        seconds_per_point = parse_walltime(state.get("h_rt", DEFAULT_H_RT)) / state["points_per_task"]
+        h_rt = format_walltime(math.ceil((seconds_per_point * points_per_task + REFINE_STARTUP_MARGIN_SECONDS) / 300) * 300)
+    backend = backend or state.get("backend", "sge")
+    write_campaign_state(pass_paths["campaign_dir"], n_fine, points_per_task, shared_params, h_rt, backend,
+                         state.get("mem", DEFAULT_MEM), cost, task_ids, state.get("tasks_per_shard"))
+
+    backend_output = BACKENDS[backend]({
+        "srp_trr_classic_path": srp_trr_classic_path,
+        "param_dir": pass_paths["param_dir"],
+        "spacecraft_model_file": pass_paths["spacecraft_model_file"],
+        "output_dir": pass_paths["output_dir"],
+        "metrics_dir": pass_paths["metrics_dir"],
+        "n_points": n_fine,
+        "points_per_task": points_per_task,
+        "shared_params": shared_params,
+        "task_ids": task_ids,
+        "tasks_per_shard": state.get("tasks_per_shard"),
+        "h_rt": h_rt,
+        "mem": state.get("mem", DEFAULT_MEM),
+        "job_script_filename": _job_script_name(refinement_pass),
+        "task_index_file": os.path.join(pass_paths["campaign_dir"], "refine_tasks.txt"),
+        "concurrency": concurrency,
+        "timeout": timeout,
+    })
+    update_campaign_state(pass_paths["campaign_dir"], {"submission_output": backend_output})
+    update_campaign_state(paths["campaign_dir"], {"refinements": refinements + [{
+        "pass": refinement_pass,
+        "submitted": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "n_points": n_fine,
+        "tolerance": tolerance,
+        "flagged_points": int(flagged.sum()),
+        "max_relative_error": float(relative_errors.max()),
+        "new_points": len(selected),
+        "tasks": len(task_ids),
+    }]})
+    print(f"Refinement pass {refinement_pass}: submitted {len(task_ids)} tasks covering {len(selected)} new points "
+          f"of a {n_fine} point spiral.")
+    return len(task_ids)
+
+def build_parser(locations=CLUSTER_LOCATIONS, default_backend="sge"):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("mission_id", help="mission ID; the model is read from {home-dir}/{mission_id}/{mission_id}.txt")
+    common.add_argument("--home-dir", default=locations["home_dir"])
+    common.add_argument("--scratch-dir", default=locations["scratch_dir"])
+    common.add_argument("--res-dir", default=locations["res_dir"])
+    common.add_argument("--srp-trr-classic", dest="srp_trr_classic_path", default=locations["srp_trr_classic_path"])
+
+    parser = argparse.ArgumentParser(description="Submit, check, resubmit and combine srp_trr_classic spiral point runs.")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    submit_parser = subparsers.add_parser("submit", parents=[common], help="generate parameter files and run them")
+    submit_parser.add_argument("--jobs", dest="concurrency", type=int, default=None, help="local backend: tasks run at once (default: one per CPU)")
+    submit_parser.add_argument("--timeout", type=float, default=None, help="local backend: kill a task after this many seconds")
+    submit_parser.add_argument("--mass", required=True, help="mass of the spacecraft (kg)")
+    submit_parser.add_argument("--points", type=int, required=True, help="number of spiral points")
+    submit_parser.add_argument("--model-type", default="0", help="0 for SRP, 1 for SRP+TRR, 2 for TRR")
+    submit_parser.add_argument("--scheme", default="1", help="0 for EPS angles, 1 for spiral points")
+    submit_parser.add_argument("--spacing", required=True, help="pixel spacing of array (m)")
+    submit_parser.add_argument("--sr-option", default="N", choices=["Y", "N"], help="include secondary reflections")
+    submit_parser.add_argument("--emissivity", default="0.0", help="MLI emissivity for TRR models")
+    packing = submit_parser.add_mutually_exclusive_group()
+    packing.add_argument("--points-per-task", type=int, default=1)
+    packing.add_argument("--walltime", help="target wall time per task (H:MM:SS)")
+    submit_parser.add_argument("--seconds-per-point", type=float, help="run time of one spiral point (s); estimated from the model if omitted")
+    submit_parser.add_argument("--auto", dest="auto_size", action="store_true", help="pick points per task, h_rt and mem from the cost model (up to --walltime per task)")
+    submit_parser.add_argument("--shared-params", action="store_true", help="write one base parameter file plus a range index")
+    submit_parser.add_argument("--shard-outputs", dest="tasks_per_shard", type=int, nargs="?", const=TASKS_PER_SHARD, default=None,
+                               metavar="TASKS_PER_SHARD", help=f"append outputs to one shard file per block of tasks (default {TASKS_PER_SHARD}) "
+                                                              "instead of a file per task; implies --shared-params")
+    submit_parser.add_argument("--backend", choices=sorted(BACKENDS), default=default_backend)
+    submit_parser.add_argument("--skip-model-check", action="store_true", help="submit even if the spacecraft model fails validation")
+
+    refinement = argparse.ArgumentParser(add_help=False)
+    refinement.add_argument("--pass", dest="refinement_pass", type=int, default=None, help="work on this adaptive refinement pass")
+
+    for mode in ("check", "combine"):
+        mode_parser = subparsers.add_parser(mode, parents=[common, refinement], help=f"{mode} the outputs of a submission")
+        mode_parser.add_argument("--points", type=int, help="number of spiral points, for submissions without campaign.json")
+        if mode == "combine":
+            mode_parser.add_argument("--incremental", action="store_true", help="only merge outputs completed since the last incremental combine")
+            mode_parser.add_argument("--no-csv", dest="write_csv", action="store_false", help="with --incremental, only update combined_output.npy")
+
+    resubmit_parser = subparsers.add_parser("resubmit", parents=[common, refinement], help="rerun failed or missing tasks")
+    resubmit_parser.add_argument("--backend", choices=sorted(BACKENDS), default=None, help="defaults to the backend used by submit")
+    resubmit_parser.add_argument("--jobs", dest="concurrency", type=int, default=None, help="local backend: tasks run at once (default: one per CPU)")
+    resubmit_parser.add_argument("--timeout", type=float, default=None, help="local backend: kill a task after this many seconds")
+
+    subparsers.add_parser("calibrate", parents=[common, refinement], help="calibrate the cost model from a finished run")
+    subparsers.add_parser("report", parents=[common, refinement], help="summarise task run times, memory, stragglers and failures")
+
+    refine_parser = subparsers.add_parser("refine", parents=[common], help="submit extra spiral points where the interpolation error is high")
+    refine_parser.add_argument("--tolerance", type=float, default=DEFAULT_REFINE_TOLERANCE, help="target leave-one-out error relative to the RMS acceleration")
+    refine_parser.add_argument("--factor", type=int, default=DEFAULT_REFINE_FACTOR, help="how many times denser each pass's spiral is")
+    refine_parser.add_argument("--points-per-task", type=int, default=1)
+    refine_parser.add_argument("--neighbors", type=int, default=None, help="nearest points used for each leave-one-out prediction")
+    refine_parser.add_argument("--backend", choices=sorted(BACKENDS), default=None, help="defaults to the backend used by submit")
+    refine_parser.add_argument("--jobs", dest="concurrency", type=int, default=None, help="local backend: tasks run at once (default: one per CPU)")
+    refine_parser.add_argument("--timeout", type=float, default=None, help="local backend: kill a task after this many seconds")
+    return parser
+
+def prompt_for_arguments():
+    """
+    Asks for the arguments interactively, as the script did before it had a command line interface.
+    """
     mission_id = input("Enter the mission ID: ")
-    mode = input("Enter mode (submit/check/combine): ")
+    mode = input("Enter mode (submit/check/combine/resubmit/report/calibrate/refine): ")
+    argv = [mode, mission_id]
 
     if mode == "submit":
-        sc_mass = input("Enter the mass of the spacecraft: ")
-        num_jobs = int(input("Enter the number of jobs: "))
-        model_type = input("Enter the type of modelling required (0 for SRP, 1 for SRP+TRR, 2 for TRR): ")
-        scheme = input("Enter the pixel array orientation scheme (0 for EPS angles, 1 for spiral points): ")
-        spacing = input("Enter the pixel spacing of array (m): ")
-        sr_option = input("Include secondary reflections? (Y or N): ")
-        emissivity = input("Enter the MLI emissivity for TRR models: ")
-        main(mission_id, mode, sc_mass, num_jobs, model_type, scheme, spacing, sr_option, emissivity)
-    else:
-        num_jobs = int(input("Enter the number of jobs to check/combine: "))
-        main(mission_id, mode, num_jobs=num_jobs)
\ No newline at end of file
+        argv += ["--mass", input("Enter the mass of the spacecraft: ")]
+        argv += ["--points", input("Enter the number of spiral points: ")]
+        argv += ["--model-type", input("Enter the type of modelling required (0 for SRP, 1 for SRP+TRR, 2 for TRR): ")]
+        argv += ["--scheme", input("Enter the pixel array orientation scheme (0 for EPS angles, 1 for spiral points): ")]
+        argv += ["--spacing", input("Enter the pixel spacing of array (m): ")]
+        argv += ["--sr-option", input("Include secondary reflections? (Y or N): ").strip().upper()]
+        argv += ["--emissivity", input("Enter the MLI emissivity for TRR models: ")]
+        if input("Use a single shared parameter file for all tasks? (Y or N, default N): ").strip().upper() == "Y":
+            argv.append("--shared-params")
+        if input("Append outputs to a few shard files instead of one file per task? (Y or N, default N): ").strip().upper() == "Y":
+            argv.append("--shard-outputs")
+        packing = input("Enter spiral points per array task, a target wall time per task as H:MM:SS, or 'auto' (default 1): ").strip()
+        if packing.lower() == "auto":
+            argv.append("--auto")
+        elif ":" in packing:
+            argv += ["--walltime", packing]
+            seconds_per_point = input("Enter the estimated run time of a single spiral point (s, blank to estimate from the model): ").strip()
+            if seconds_per_point:
+                argv += ["--seconds-per-point", seconds_per_point]
+        else:
+            argv += ["--points-per-task", packing or "1"]
+    elif mode in ("check", "combine"):
+        points = input("Enter the number of spiral points to check/combine (blank to use campaign.json): ").strip()
+        if points:
+            argv += ["--points", points]
+    return argv
+
+def main(argv=None, locations=CLUSTER_LOCATIONS, default_backend="sge"):
+    if argv is None:
+        argv = sys.argv[1:] or prompt_for_arguments()
+    parser = build_parser(locations, default_backend)
+    args = parser.parse_args(argv)
+
+    if args.mode == "submit":
+        if args.walltime and args.seconds_per_point is None and cost_model is None:
+            parser.error("--walltime needs --seconds-per-point when NumPy is not available")
+        submit(args.mission_id, args.points, args.mass, args.model_type, args.scheme, args.spacing, args.sr_option, args.emissivity,
+               points_per_task=args.points_per_task, target_walltime=args.walltime, seconds_per_point=args.seconds_per_point,
+               shared_params=args.shared_params, backend=args.backend, home_dir=args.home_dir, scratch_dir=args.scratch_dir,
+               res_dir=args.res_dir, srp_trr_classic_path=args.srp_trr_classic_path, concurrency=args.concurrency, timeout=args.timeout,
+               skip_model_check=args.skip_model_check, auto_size=args.auto_size, tasks_per_shard=args.tasks_per_shard)
+    elif args.mode == "check":
+        check(args.mission_id, args.points, home_dir=args.home_dir, scratch_dir=args.scratch_dir, refinement_pass=args.refinement_pass)
+    elif args.mode == "combine":
+        combine(args.mission_id, args.points, scratch_dir=args.scratch_dir, incremental=args.incremental, write_csv=args.write_csv,
+                refinement_pass=args.refinement_pass)
+    elif args.mode == "resubmit":
+        resubmit(args.mission_id, args.backend, home_dir=args.home_dir, scratch_dir=args.scratch_dir,
+                 srp_trr_classic_path=args.srp_trr_classic_path, concurrency=args.concurrency, timeout=args.timeout,
+                 refinement_pass=args.refinement_pass)
+    elif args.mode == "report":
+        report(args.mission_id, home_dir=args.home_dir, scratch_dir=args.scratch_dir, refinement_pass=args.refinement_pass)
+    elif args.mode == "calibrate":
+        calibrate(args.mission_id, home_dir=args.home_dir, scratch_dir=args.scratch_dir, refinement_pass=args.refinement_pass)
+    elif args.mode == "refine":
+        refine(args.mission_id, args.tolerance, args.factor, args.points_per_task, args.backend, args.neighbors,
+               home_dir=args.home_dir, scratch_dir=args.scratch_dir, res_dir=args.res_dir,
+               srp_trr_classic_path=args.srp_trr_classic_path, concurrency=args.concurrency, timeout=args.timeout)
+
+if __name__ == "__main__":
+    main()
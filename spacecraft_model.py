@@ -0,0 +1,264 @@
+import os
+import sys
+import hashlib
+import numpy as np
+
+# Spacecraft model files are a sequence of blocks, each opening with a keyword line:
+#
+#   GENERAL                      flat polygon panel
+#   0 // 001 0001 +Z_face:MLI    panel id // label
+#   8                            number of vertices
+#   x y z                        one line per vertex
+#   a b c d                      optical properties
+#
+# The primitive blocks carry scalar dimensions and defining points instead of a vertex list:
+# CYL_X (radius; two axis end points), CIRCLE (radius; centre and two points in its plane) and
+# TCONEO/TCONEI (length, two end radii; two axis end points).
+KIND_NAMES = ("GENERAL", "CYL_X", "CIRCLE", "TCONEO", "TCONEI")
+# Expected (number of scalar lines, number of point lines) per kind; None means "given by the count"
+KIND_LAYOUT = {
+    "GENERAL": (1, None),
+    "CYL_X": (1, 2),
+    "CIRCLE": (1, 3),
+    "TCONEO": (3, 2),
+    "TCONEI": (3, 2),
+}
+OPTICAL_FIELDS = 4
+# A panel is non-planar if a vertex is further than this fraction of its extent from the best-fit plane
+PLANARITY_TOLERANCE = 1e-4
+DEGENERATE_AREA = 1e-12
+MODEL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "myriad_utils_py", "models")
+# Part of the .npz cache key; bump it whenever parse_model's output changes so stale copies are not reused
+MODEL_CACHE_VERSION = 1
+
+def _parse_blocks(lines):
+    """
+    Splits model file lines into blocks of (kind, id line, [(line number, values)], first line number).
+    """
+    blocks = []
+    issues = []
+    for line_number, line in enumerate(lines, start=1):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if stripped[0].isalpha():
+            blocks.append([stripped.split()[0], None, [], line_number])
+        elif not blocks:
+            issues.append(("error", line_number, "data before the first block keyword"))
+        elif blocks[-1][1] is None:
+            blocks[-1][1] = stripped
+        else:
+            try:
+                blocks[-1][2].append((line_number, [float(token) for token in stripped.split()]))
+            except ValueError:
+                issues.append(("error", line_number, f"non-numeric line: {stripped!r}"))
+    return blocks, issues
+
+def parse_model(file_path):
+    """
+    Parses a spacecraft model file into compact NumPy arrays.
+
+    :param file_path: Path to the model file.
+    :return: Dict with one entry per panel in "kinds" (index into KIND_NAMES), "ids", "labels",
+        "optical" (panels x OPTICAL_FIELDS) and "lines" (line number of the block keyword), plus
+        the flattened "points" (n x 3) and "scalars" arrays with per-panel "point_offsets" and
+        "scalar_offsets" (panels + 1), and "issues": a list of (severity, line number, message).
+    """
+    with open(file_path, 'r') as file:
+        blocks, issues = _parse_blocks(file.read().splitlines())
+
+    kinds, ids, labels, optical, block_lines = [], [], [], [], []
+    points, scalars = [], []
+    point_offsets, scalar_offsets = [0], [0]
+
+    for kind, id_line, values, line_number in blocks:
+        if kind not in KIND_LAYOUT:
+            issues.append(("error", line_number, f"unknown block type {kind}"))
+            continue
+        if id_line is None:
+            issues.append(("error", line_number, f"{kind} block has no id line"))
+            continue
+        panel_id, _, label = id_line.partition("//")
+        try:
+            panel_id = int(panel_id)
+        except ValueError:
+            issues.append(("error", line_number, f"bad panel id line {id_line!r}"))
+            panel_id = -1
+
+        block_scalars = [row[0] for _, row in values if len(row) == 1]
+        block_points = [row for _, row in values if len(row) == 3]
+        block_optical = [row for _, row in values if len(row) == OPTICAL_FIELDS]
+        for value_line, row in values:
+            if len(row) not in (1, 3, OPTICAL_FIELDS):
+                issues.append(("warning", value_line, f"panel {panel_id}: unexpected {len(row)}-value line ignored"))
+
+        scalar_count, point_count = KIND_LAYOUT[kind]
+        if kind == "GENERAL" and block_scalars:
+            point_count = int(block_scalars[0])
+        if len(block_scalars) != scalar_count:
+            issues.append(("error", line_number, f"panel {panel_id}: {kind} expects {scalar_count} scalar lines, found {len(block_scalars)}"))
+        if len(block_points) != point_count:
+            issues.append(("error", line_number, f"panel {panel_id}: expected {point_count} vertices, found {len(block_points)}"))
+        if len(block_optical) != 1:
+            issues.append(("error", line_number, f"panel {panel_id}: expected 1 optical property line, found {len(block_optical)}"))
+            block_optical = [[np.nan] * OPTICAL_FIELDS]
+
+        kinds.append(KIND_NAMES.index(kind))
+        ids.append(panel_id)
+        labels.append(label.strip())
+        optical.append(block_optical[0])
+        block_lines.append(line_number)
+        points.extend(block_points)
+        scalars.extend(block_scalars)
+        point_offsets.append(len(points))
+        scalar_offsets.append(len(scalars))
+
+    return {
+        "kinds": np.array(kinds, dtype=np.uint8),
+        "ids": np.array(ids, dtype=np.int64),
+        "labels": np.array(labels, dtype=str),
+        "optical": np.array(optical, dtype=float).reshape(-1, OPTICAL_FIELDS),
+        "lines": np.array(block_lines, dtype=np.int64),
+        "points": np.array(points, dtype=float).reshape(-1, 3),
+        "point_offsets": np.array(point_offsets, dtype=np.int64),
+        "scalars": np.array(scalars, dtype=float),
+        "scalar_offsets": np.array(scalar_offsets, dtype=np.int64),
+        "issues": issues,
+    }
+
+def panel_geometry(model):
+    """
+    Computes the surface area and axis-aligned bounding box of every panel.
+
+    Areas of the primitives are analytic: the lateral surface for CYL_X and TCONEO/TCONEI, the
+    disc for CIRCLE. Their bounding boxes are padded by the largest radius.
+
+    :return: Tuple of (areas, bounding boxes as panels x 2 x 3 [min, max], GENERAL panel normals).
+    """
+    n_panels = len(model["kinds"])
+    areas = np.zeros(n_panels)
+    boxes = np.full((n_panels, 2, 3), np.nan)
+    normals = np.full((n_panels, 3), np.nan)
+    points, scalars = model["points"], model["scalars"]
+
+    for panel in range(n_panels):
+        panel_points = points[model["point_offsets"][panel]:model["point_offsets"][panel + 1]]
+        panel_scalars = scalars[model["scalar_offsets"][panel]:model["scalar_offsets"][panel + 1]]
+        if len(panel_points) == 0:
+            continue
+        kind = KIND_NAMES[model["kinds"][panel]]
+        padding = 0.0
+        if kind == "GENERAL":
+            # Newell's method: the vector area of a planar polygon, robust to concave outlines
+            following = np.roll(panel_points, -1, axis=0)
+            vector_area = 0.5 * np.cross(panel_points, following).sum(axis=0)
+            areas[panel] = np.linalg.norm(vector_area)
+            if areas[panel] > 0:
+                normals[panel] = vector_area / areas[panel]
+        elif kind == "CYL_X" and len(panel_points) == 2 and len(panel_scalars) == 1:
+            padding = panel_scalars[0]
+            areas[panel] = 2 * np.pi * panel_scalars[0] * np.linalg.norm(panel_points[1] - panel_points[0])
+        elif kind == "CIRCLE" and len(panel_scalars) == 1:
+            padding = panel_scalars[0]
+            areas[panel] = np.pi * panel_scalars[0] ** 2
+        elif kind in ("TCONEO", "TCONEI") and len(panel_scalars) == 3:
+            length, radius_1, radius_2 = panel_scalars
+            padding = max(radius_1, radius_2)
+            areas[panel] = np.pi * (radius_1 + radius_2) * np.hypot(length, radius_2 - radius_1)
+        boxes[panel, 0] = panel_points.min(axis=0) - padding
+        boxes[panel, 1] = panel_points.max(axis=0) + padding
+    return areas, boxes, normals
+
+def validate_model(model):
+    """
+    Checks a parsed model for problems that would make srp_trr_classic fail or mislead.
+
+    Adds to the parse issues: GENERAL panels with fewer than 3 vertices, zero area or vertices off
+    their best-fit plane; primitives with non-positive dimensions or coincident axis end points;
+    non-finite optical properties and duplicate panel ids.
+
+    :return: List of (severity, line number, message), errors first.
+    """
+    issues = list(model["issues"])
+    areas, _, normals = panel_geometry(model)
+    points, scalars = model["points"], model["scalars"]
+
+    for panel, kind_index in enumerate(model["kinds"]):
+        kind = KIND_NAMES[kind_index]
+        line_number = int(model["lines"][panel])
+        panel_id = int(model["ids"][panel])
+        panel_points = points[model["point_offsets"][panel]:model["point_offsets"][panel + 1]]
+        panel_scalars = scalars[model["scalar_offsets"][panel]:model["scalar_offsets"][panel + 1]]
+
+        if not np.all(np.isfinite(model["optical"][panel])):
+            issues.append(("error", line_number, f"panel {panel_id}: missing or non-finite optical properties"))
+        if kind == "GENERAL":
+            if len(panel_points) < 3:
+                issues.append(("error", line_number, f"panel {panel_id}: polygon has {len(panel_points)} vertices"))
+                continue
+            extent = np.ptp(panel_points, axis=0).max()
+            if areas[panel] <= DEGENERATE_AREA:
+                issues.append(("error", line_number, f"panel {panel_id}: degenerate polygon (area {areas[panel]:.3g} m^2)"))
+                continue
+            offsets = (panel_points - panel_points.mean(axis=0)) @ normals[panel]
+            if np.abs(offsets).max() > PLANARITY_TOLERANCE * extent:
+                issues.append(("error", line_number, f"panel {panel_id}: non-planar, vertex {np.abs(offsets).max():.3g} m off the panel plane"))
+        else:
+            if np.any(panel_scalars <= 0):
+                issues.append(("error", line_number, f"panel {panel_id}: {kind} has non-positive dimensions {panel_scalars.tolist()}"))
+            if kind != "CIRCLE" and len(panel_points) == 2 and np.allclose(panel_points[0], panel_points[1]):
+                issues.append(("error", line_number, f"panel {panel_id}: {kind} axis end points coincide"))
+
+    unique_ids, counts = np.unique(model["ids"], return_counts=True)
+    for panel_id in unique_ids[counts > 1]:
+        issues.append(("warning", 0, f"panel id {panel_id} is used {counts[unique_ids == panel_id][0]} times"))
+
+    return sorted(issues, key=lambda issue: (issue[0] != "error", issue[1]))
+
+def load_model(file_path, cache_dir=MODEL_CACHE_DIR):
+    """
+    Parses a model file, reusing a binary .npz copy keyed on a hash of its contents and
+    MODEL_CACHE_VERSION if available.
+    """
+    with open(file_path, 'rb') as file:
+        digest = hashlib.sha256(file.read()).hexdigest()
+    cache_path = os.path.join(cache_dir, f"{digest}.v{MODEL_CACHE_VERSION}.npz") if cache_dir else None
+
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            model = {name: cached[name] for name in cached.files if name != "issues"}
+            model["issues"] = [(severity, int(line), message) for severity, line, message in cached["issues"]]
+        return model
+
+    model = parse_model(file_path)
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        arrays = {name: value for name, value in model.items() if name != "issues"}
+        issues = np.array(model["issues"], dtype=str).reshape(-1, 3)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, issues=issues, **arrays)
+        os.replace(tmp_path, cache_path)
+    return model
+
+def model_report(model, issues=None):
+    """
+    Returns a short human readable summary of a parsed model and its validation issues.
+    """
+    areas, boxes, _ = panel_geometry(model)
+    kinds, counts = np.unique(model["kinds"], return_counts=True)
+    report = [
+        f"Panels: {len(model['kinds'])} (" + ", ".join(f"{KIND_NAMES[k]}: {c}" for k, c in zip(kinds, counts)) + ")",
+        f"Total surface area: {areas.sum():.4f} m^2",
+        f"Bounding box: min {np.nanmin(boxes[:, 0], axis=0).round(4).tolist()} max {np.nanmax(boxes[:, 1], axis=0).round(4).tolist()}",
+    ]
+    if len(areas):
+        largest = int(np.argmax(areas))
+        report.append(f"Largest panel: {model['ids'][largest]} {model['labels'][largest]} ({areas[largest]:.4f} m^2)")
+    for severity, line_number, message in (issues if issues is not None else validate_model(model)):
+        report.append(f"{severity}: line {line_number}: {message}")
+    return "\n".join(report)
+
+if __name__ == "__main__":
+    for model_file in sys.argv[1:]:
+        print(f"{model_file}:")
+        print(model_report(load_model(model_file)))